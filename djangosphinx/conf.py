@@ -11,8 +11,22 @@ __all__ = [
     'SEARCHD_SETTINGS',
     'SPHINX_MAX_MATCHES',
     'SPHINX_QUERY_OPTS', 'SPHINX_QUERY_LIMIT',
-    'SPHINX_SNIPPETS', 'SPHINX_SNIPPETS_OPTS',
+    'SPHINX_SNIPPETS', 'SPHINX_SNIPPETS_OPTS', 'SPHINX_SNIPPETS_MIN_BUDGET',
     'SPHINX_ESCAPE_FIELD_SEARCH_OPERATOR',
+    'SPHINX_POOL_SIZE', 'SPHINX_POOL_TIMEOUT',
+    'SPHINX_POOL_MAX_IDLE', 'SPHINX_CONN_MAX_AGE', 'SPHINX_POOL_PREWARM',
+    'SPHINX_PING_IDLE_TIME',
+    'SPHINX_BALANCER', 'SPHINX_NODE_COOLDOWN',
+    'SPHINX_NODE_RETRIES', 'SPHINX_NODE_RETRY_DELAY',
+    'SPHINX_BREAKER_THRESHOLD', 'SPHINX_BREAKER_PROBE_INTERVAL', 'SPHINX_BREAKER_FALLBACK',
+    'SPHINX_WORKER_THREADS', 'SPHINX_DB_BACKEND', 'SPHINX_FAN_OUT',
+    'SPHINX_PARALLEL_HYDRATION',
+    'SPHINX_OBJECT_CACHE', 'SPHINX_OBJECT_CACHE_SIZE', 'SPHINX_OBJECT_CACHE_TTL',
+    'SPHINX_OBJECT_CACHE_BACKEND',
+    'SPHINX_RESULT_CACHE_TTL', 'SPHINX_RESULT_CACHE_SIZE', 'SPHINX_RESULT_CACHE_BACKEND',
+    'SPHINX_RESULT_CACHE_STALE_TTL', 'SPHINX_RESULT_CACHE_REFRESH_THREADS', 'SPHINX_RESULT_CACHE_LEASE',
+    'SPHINX_NEGATIVE_CACHE_TTL', 'SPHINX_NEGATIVE_CACHE_SIZE',
+    'SPHINX_FETCH_SIZE',
 ]
 
 DOCUMENT_ID_SHIFT = getattr(settings, 'SPHINX_DOCUMENT_ID_SHIFT', 52)
@@ -31,7 +45,95 @@ SEARCHD_SETTINGS = {
     'max_matches': SPHINX_MAX_MATCHES,
 }
 
+# Список узлов searchd: [{'host': ..., 'port': ..., 'weight': ..., 'writer': ...}, ...]
+# По-умолчанию - единственный узел SPHINX_HOST:SPHINX_PORT
+SEARCHD_SETTINGS['nodes'] = [dict(n) for n in getattr(settings, 'SPHINX_NODES', [])] or [
+    dict(host=SEARCHD_SETTINGS['sphinx_host'], port=SEARCHD_SETTINGS['sphinx_port']),
+]
+for _node in SEARCHD_SETTINGS['nodes']:
+    assert('host' in _node and 'port' in _node)
+    _node.setdefault('weight', 1)
+
+SPHINX_BALANCER = getattr(settings, 'SPHINX_BALANCER', 'round_robin')
+# на сколько секунд узел исключается из балансировки после сбоя
+SPHINX_NODE_COOLDOWN = getattr(settings, 'SPHINX_NODE_COOLDOWN', 30)
+# сколько раз повторять запрос на чтение на другом узле
+SPHINX_NODE_RETRIES = int(getattr(settings, 'SPHINX_NODE_RETRIES', 2))
+# пауза перед повтором, удваивается с каждой попыткой, но не больше секунды
+SPHINX_NODE_RETRY_DELAY = getattr(settings, 'SPHINX_NODE_RETRY_DELAY', 0.05)
+
+# предохранитель: после стольких сбоев подряд запросы к searchd отклоняются сразу
+# (0 - отключен), через SPHINX_BREAKER_PROBE_INTERVAL секунд пропускается пробный запрос
+SPHINX_BREAKER_THRESHOLD = int(getattr(settings, 'SPHINX_BREAKER_THRESHOLD', 5))
+SPHINX_BREAKER_PROBE_INTERVAL = float(getattr(settings, 'SPHINX_BREAKER_PROBE_INTERVAL', 10))
+# что возвращает выборка при разомкнутом предохранителе: raise или empty
+SPHINX_BREAKER_FALLBACK = getattr(settings, 'SPHINX_BREAKER_FALLBACK', 'raise')
+
+assert(SPHINX_BREAKER_FALLBACK in ('raise', 'empty'))
+
+# Драйвер SphinxQL: mysqldb, pymysql, native или путь к классу
+SPHINX_DB_BACKEND = getattr(settings, 'SPHINX_DB_BACKEND', 'mysqldb')
+# сколько строк результата читать с курсора за один вызов fetchmany
+SPHINX_FETCH_SIZE = int(getattr(settings, 'SPHINX_FETCH_SIZE', 1000))
+
+assert(SPHINX_FETCH_SIZE > 0)
+
+# Пул подключений к searchd
+SPHINX_POOL_SIZE = int(getattr(settings, 'SPHINX_POOL_SIZE', 10))
+SPHINX_POOL_TIMEOUT = float(getattr(settings, 'SPHINX_POOL_TIMEOUT', 5))
+SPHINX_POOL_MAX_IDLE = getattr(settings, 'SPHINX_POOL_MAX_IDLE', 300)
+# время жизни подключения, аналог CONN_MAX_AGE: None - не ограничено,
+# 0 - подключения закрываются в конце каждого запроса
+SPHINX_CONN_MAX_AGE = getattr(settings, 'SPHINX_CONN_MAX_AGE',
+                              getattr(settings, 'SPHINX_POOL_MAX_LIFETIME', None))
+# сколько подключений к каждому узлу открыть заранее при старте процесса
+SPHINX_POOL_PREWARM = int(getattr(settings, 'SPHINX_POOL_PREWARM', 0))
+# подключение проверяется ping'ом, только если оно простаивало дольше
+SPHINX_PING_IDLE_TIME = getattr(settings, 'SPHINX_PING_IDLE_TIME', 30)
+
+assert(SPHINX_POOL_SIZE > 0)
+
+# потоки для фонового выполнения запросов (SphinxQuerySet.fetch_async, SPHINX_FAN_OUT,
+# SPHINX_PARALLEL_HYDRATION)
+SPHINX_WORKER_THREADS = int(getattr(settings, 'SPHINX_WORKER_THREADS', SPHINX_POOL_SIZE))
+# запросы к нескольким индексам выполняются параллельно, по индексу на поток
+SPHINX_FAN_OUT = bool(getattr(settings, 'SPHINX_FAN_OUT', False))
+# объекты разных моделей запрашиваются из БД параллельно, по модели на поток
+SPHINX_PARALLEL_HYDRATION = bool(getattr(settings, 'SPHINX_PARALLEL_HYDRATION', False))
+
+# кэш объектов, получаемых из БД по результатам поиска
+SPHINX_OBJECT_CACHE = bool(getattr(settings, 'SPHINX_OBJECT_CACHE', False))
+SPHINX_OBJECT_CACHE_SIZE = int(getattr(settings, 'SPHINX_OBJECT_CACHE_SIZE', 10000))
+SPHINX_OBJECT_CACHE_TTL = getattr(settings, 'SPHINX_OBJECT_CACHE_TTL', 60)
+# название кэша из CACHES, общего для процессов; None - только память процесса
+SPHINX_OBJECT_CACHE_BACKEND = getattr(settings, 'SPHINX_OBJECT_CACHE_BACKEND', None)
+
+assert(SPHINX_OBJECT_CACHE_SIZE > 0)
+
+# кэш результатов поиска; время жизни по-умолчанию для всех выборок, None - не кэшировать
+SPHINX_RESULT_CACHE_TTL = getattr(settings, 'SPHINX_RESULT_CACHE_TTL', None)
+# сколько секунд с момента сохранения результат можно отдавать устаревшим, обновляя его в фоне
+SPHINX_RESULT_CACHE_STALE_TTL = getattr(settings, 'SPHINX_RESULT_CACHE_STALE_TTL', None)
+# потоки фоновых обновлений; обновление, для которого нет свободного потока, пропускается
+SPHINX_RESULT_CACHE_REFRESH_THREADS = int(getattr(settings, 'SPHINX_RESULT_CACHE_REFRESH_THREADS', 2))
+SPHINX_RESULT_CACHE_SIZE = int(getattr(settings, 'SPHINX_RESULT_CACHE_SIZE', 1000))
+SPHINX_RESULT_CACHE_BACKEND = getattr(settings, 'SPHINX_RESULT_CACHE_BACKEND', None)
+# промах по кэшу выполняет один процесс, получив блокировку в SPHINX_RESULT_CACHE_BACKEND
+# на столько секунд; None - каждый процесс выполняет запрос сам
+SPHINX_RESULT_CACHE_LEASE = getattr(settings, 'SPHINX_RESULT_CACHE_LEASE', None)
+
+assert(SPHINX_RESULT_CACHE_SIZE > 0)
+assert(SPHINX_RESULT_CACHE_REFRESH_THREADS > 0)
+
+# запросы без результатов запоминаются на столько секунд; None - не запоминать
+SPHINX_NEGATIVE_CACHE_TTL = getattr(settings, 'SPHINX_NEGATIVE_CACHE_TTL', None)
+SPHINX_NEGATIVE_CACHE_SIZE = int(getattr(settings, 'SPHINX_NEGATIVE_CACHE_SIZE', 10000))
+
+assert(SPHINX_NEGATIVE_CACHE_SIZE > 0)
+
 SPHINX_SNIPPETS = bool(getattr(settings, 'SPHINX_SNIPPETS', False))
+# сниппеты не строятся, если до истечения времени запроса осталось меньше (сек.)
+SPHINX_SNIPPETS_MIN_BUDGET = getattr(settings, 'SPHINX_SNIPPETS_MIN_BUDGET', 0.05)
 
 _snip_opts = getattr(settings, 'SPHINX_SNIPPETS_OPTIONS', {})
 
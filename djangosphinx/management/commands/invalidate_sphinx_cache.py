@@ -0,0 +1,29 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    args = '[index ...]'
+    help = "Invalidates cached search results for the given indexes (all known indexes by default). " \
+           "Run it after rotating indexes with `indexer --rotate`."
+
+    def handle(self, *args, **options):
+        from djangosphinx.query.cache import result_cache
+        from djangosphinx.registry import registry
+
+        if result_cache.backend is None:
+            # версии индексов хранятся только в памяти процессов
+            self.stderr.write('SPHINX_RESULT_CACHE_BACKEND is not set, other processes are not affected\n')
+
+        indexes = list(args)
+        if not indexes:
+            for index in registry.indexes:
+                indexes.append(index)
+                model = registry.get_index(index).model
+                if model.__sphinx_options__.get('realtime', False):
+                    indexes.append('%s_rt' % model._meta.db_table)
+
+        result_cache.bump(*indexes)
+        self.stdout.write('Invalidated: %s\n' % ' '.join(indexes))
@@ -3,7 +3,11 @@ from __future__ import unicode_literals, absolute_import
 
 import warnings
 
-from .query import SphinxQuerySet, SearchError
+from django.db.models.signals import post_save, post_delete
+
+from .conf import SPHINX_OBJECT_CACHE
+from .query import SphinxQuerySet, SearchError, SearchTimeout, CircuitOpen, search_budget
+from .query.cache import invalidate_object
 
 
 class SphinxModelManager(object):
@@ -73,4 +77,8 @@ class SphinxSearch(object):
         setattr(model, '__sphinx_indexes__', [self._index])
         setattr(model, '__sphinx_options__', self._options)
 
+        if self._options.get('object_cache', SPHINX_OBJECT_CACHE):
+            post_save.connect(invalidate_object, sender=model)
+            post_delete.connect(invalidate_object, sender=model)
+
         setattr(model, name, self._sphinx)
@@ -4,7 +4,9 @@ from __future__ import absolute_import, unicode_literals
 __author__ = 'ego'
 
 from .queryset import SphinxQuerySet, SearchError
-from .query import ConnectionError
+from .query import ConnectionError, CircuitOpen, PoolExhausted
+from .budget import SearchTimeout, search_budget
 
-__all__ = ['ConnectionError',
-           'SphinxQuerySet', 'SearchError']
+__all__ = ['ConnectionError', 'CircuitOpen', 'PoolExhausted',
+           'SphinxQuerySet', 'SearchError',
+           'SearchTimeout', 'search_budget']
@@ -0,0 +1,29 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+from threading import Lock
+
+from django.utils.importlib import import_module
+
+__all__ = ['BACKENDS', 'get_backend']
+
+BACKENDS = dict(
+    mysqldb='djangosphinx.query.backends.mysqldb.Backend',
+    pymysql='djangosphinx.query.backends.pymysql.Backend',
+    native='djangosphinx.query.backends.native.Backend',
+)
+
+_backends = {}
+_lock = Lock()
+
+
+def get_backend(name):
+    """
+    Возвращает драйвер SphinxQL по имени из BACKENDS или по полному пути
+    к классу. Модуль драйвера импортируется только при первом обращении.
+    """
+    with _lock:
+        if name not in _backends:
+            module, attr = BACKENDS.get(name, name).rsplit('.', 1)
+            _backends[name] = getattr(import_module(module), attr)()
+        return _backends[name]
@@ -0,0 +1,75 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import time
+
+from threading import Lock
+
+__all__ = ['BaseBackend', 'DISCONNECT_ERRORS']
+
+# MySQL client errors: server has gone away, lost connection during query,
+# lost connection to server at '%s'
+DISCONNECT_ERRORS = (2006, 2013, 2055)
+
+
+class BaseBackend(object):
+    """
+    Драйвер SphinxQL. Подключения и курсоры, которые он создаёт,
+    должны поддерживать DB API 2.0 (execute, fetch*, description, rowcount,
+    nextset) и метод ping() у подключения. Подключения должны разрешать
+    multi-statement запросы: SELECT и SHOW META отправляются вместе.
+
+    Каждый драйвер собирает статистику:
+
+    - queries - количество выполненных запросов;
+    - rows - количество полученных строк;
+    - query_time - время выполнения запросов на клиенте, включая сеть и разбор строк;
+    - decode_time - время разбора строк, если драйвер может измерить его отдельно.
+    """
+    name = None
+
+    # классы исключений драйвера
+    Error = None
+    OperationalError = None
+    ProgrammingError = None
+
+    def __init__(self):
+        self._lock = Lock()
+        self.stats = dict(queries=0, rows=0, query_time=0.0, decode_time=0.0)
+
+    def connect(self, host, port):
+        raise NotImplementedError
+
+    def execute(self, cursor, query, args=None):
+        start = time.time()
+        cursor.execute(query, args)
+        self.record(rows=max(cursor.rowcount, 0), query_time=time.time() - start)
+
+    def set_timeout(self, connection, timeout):
+        """
+        Ограничивает время ожидания ответа на подключении (None - без ограничения).
+
+        :returns: False, если драйвер этого не поддерживает
+        """
+        return False
+
+    def fetchmany(self, cursor, size):
+        return cursor.fetchmany(size)
+
+    def results(self, cursor):
+        """Перебирает наборы результатов multi-statement запроса"""
+        while True:
+            yield cursor
+            if not cursor.nextset():
+                break
+
+    def is_disconnect(self, exc):
+        return isinstance(exc, self.OperationalError) \
+               and bool(exc.args) and exc.args[0] in DISCONNECT_ERRORS
+
+    def record(self, queries=1, rows=0, query_time=0.0, decode_time=0.0):
+        with self._lock:
+            self.stats['queries'] += queries
+            self.stats['rows'] += rows
+            self.stats['query_time'] += query_time
+            self.stats['decode_time'] += decode_time
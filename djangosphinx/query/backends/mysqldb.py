@@ -0,0 +1,21 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import MySQLdb
+
+from MySQLdb.constants import CLIENT
+
+from djangosphinx.query.backends.base import BaseBackend
+
+
+class Backend(BaseBackend):
+    """mysqlclient (MySQLdb). Строки разбираются в C во время execute()"""
+    name = 'mysqldb'
+
+    Error = MySQLdb.Error
+    OperationalError = MySQLdb.OperationalError
+    ProgrammingError = MySQLdb.ProgrammingError
+
+    def connect(self, host, port):
+        return MySQLdb.connect(host=host, port=port, charset='utf8', use_unicode=False,
+                               client_flag=CLIENT.MULTI_STATEMENTS | CLIENT.MULTI_RESULTS)
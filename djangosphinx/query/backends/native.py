@@ -0,0 +1,371 @@
+# coding: utf-8
+"""
+Минимальный клиент протокола MySQL 4.1 на чистом Python, достаточный
+для SphinxQL: searchd не требует авторизации и отвечает только текстовыми
+наборами результатов, поэтому handshake и разбор ответов сильно упрощены.
+"""
+from __future__ import unicode_literals
+
+import socket
+import struct
+import time
+
+import six
+
+from djangosphinx.query.backends.base import BaseBackend
+
+__all__ = ['Backend', 'Connection', 'Cursor',
+           'Error', 'OperationalError', 'ProgrammingError']
+
+CLIENT_LONG_PASSWORD = 0x1
+CLIENT_PROTOCOL_41 = 0x200
+CLIENT_SECURE_CONNECTION = 0x8000
+CLIENT_MULTI_STATEMENTS = 0x10000
+CLIENT_MULTI_RESULTS = 0x20000
+
+CLIENT_FLAGS = CLIENT_LONG_PASSWORD | CLIENT_PROTOCOL_41 | CLIENT_SECURE_CONNECTION \
+    | CLIENT_MULTI_STATEMENTS | CLIENT_MULTI_RESULTS
+
+COM_QUIT = 0x01
+COM_QUERY = 0x03
+COM_PING = 0x0e
+
+SERVER_MORE_RESULTS_EXISTS = 0x08
+
+MAX_PACKET = 0xffffff
+UTF8_GENERAL_CI = 33
+
+# типы колонок, приводимые к int и float; остальные возвращаются как bytes
+INT_TYPES = frozenset([1, 2, 3, 8, 9, 13])      # TINY, SHORT, LONG, LONGLONG, INT24, YEAR
+FLOAT_TYPES = frozenset([0, 4, 5, 246])         # DECIMAL, FLOAT, DOUBLE, NEWDECIMAL
+
+# ошибки searchd, относящиеся к тексту запроса
+PROGRAMMING_ERRORS = frozenset([1064, 1146])
+
+
+class Error(Exception):
+    pass
+
+
+class OperationalError(Error):
+    pass
+
+
+class ProgrammingError(Error):
+    pass
+
+
+def escape(value):
+    """Приводит аргумент запроса к литералу SphinxQL"""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, six.integer_types):
+        return six.text_type(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, six.binary_type):
+        value = value.decode('utf-8')
+    value = six.text_type(value)
+    for c, e in (('\\', '\\\\'), ('\0', '\\0'), ('\n', '\\n'), ('\r', '\\r'),
+                 ('\x1a', '\\Z'), ("'", "\\'"), ('"', '\\"')):
+        value = value.replace(c, e)
+    return "'%s'" % value
+
+
+def _lenenc_int(buf, pos):
+    first = buf[pos]
+    if first < 0xfb:
+        return first, pos + 1
+    if first == 0xfc:
+        return buf[pos + 1] | buf[pos + 2] << 8, pos + 3
+    if first == 0xfd:
+        return buf[pos + 1] | buf[pos + 2] << 8 | buf[pos + 3] << 16, pos + 4
+    return struct.unpack_from(b'<Q', bytes(buf[pos + 1:pos + 9]))[0], pos + 9
+
+
+def _lenenc_str(buf, pos):
+    length, pos = _lenenc_int(buf, pos)
+    return bytes(buf[pos:pos + length]), pos + length
+
+
+class Connection(object):
+
+    def __init__(self, host, port, timeout=None, connect_timeout=10, backend=None):
+        self.backend = backend
+        self._buffer = bytearray()
+        try:
+            self._sock = socket.create_connection((host, port), connect_timeout)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sock.settimeout(timeout)
+            self._handshake()
+        except socket.error as e:
+            self._sock = None
+            raise OperationalError(2003, 'Can\'t connect to searchd on \'%s:%s\' (%s)' % (host, port, e))
+
+    def cursor(self):
+        return Cursor(self, self.backend)
+
+    def ping(self):
+        self._command(COM_PING)
+        self._read_ok(self._read_packet())
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._command(COM_QUIT)
+            except Error:
+                pass
+            self._sock.close()
+            self._sock = None
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def query(self, sql):
+        """
+        Выполняет запрос и читает все наборы результатов.
+
+        :returns: список (description, raw_rows, affected_rows), где raw_rows -
+                  неразобранные пакеты строк; и время, затраченное на сеть
+        """
+        start = time.time()
+        self._command(COM_QUERY, sql.encode('utf-8'))
+
+        results = []
+        while True:
+            packet = self._read_packet()
+            if packet[0] == 0x00:
+                affected, pos = _lenenc_int(packet, 1)
+                _, pos = _lenenc_int(packet, pos)
+                status = packet[pos] | packet[pos + 1] << 8
+                results.append((None, [], affected))
+            else:
+                self._check_error(packet)
+                count, _ = _lenenc_int(packet, 0)
+                description = tuple(self._read_column() for x in range(count))
+                self._read_packet()  # EOF после описания колонок
+
+                rows = []
+                while True:
+                    packet = self._read_packet()
+                    if packet[0] == 0xfe and len(packet) < 9:
+                        status = packet[3] | packet[4] << 8
+                        break
+                    self._check_error(packet)
+                    rows.append(packet)
+                results.append((description, rows, len(rows)))
+
+            if not status & SERVER_MORE_RESULTS_EXISTS:
+                return results, time.time() - start
+
+    ## protocol
+
+    def _handshake(self):
+        self._check_error(self._read_packet())
+
+        payload = struct.pack(b'<IIB23x', CLIENT_FLAGS, MAX_PACKET, UTF8_GENERAL_CI)
+        payload += b'\0\0'  # пустые имя пользователя и ответ авторизации
+        self._send_packet(payload, 1)
+
+        self._read_ok(self._read_packet())
+
+    def _read_column(self):
+        packet = self._read_packet()
+        pos = 0
+        for x in range(4):  # catalog, schema, table, org_table
+            _, pos = _lenenc_str(packet, pos)
+        name, pos = _lenenc_str(packet, pos)
+        _, pos = _lenenc_str(packet, pos)  # org_name
+        column_type = packet[pos + 7]
+        return (name.decode('utf-8'), column_type, None, None, None, None, True)
+
+    def _command(self, command, payload=b''):
+        if self._sock is None:
+            raise OperationalError(2006, 'Connection to searchd is closed')
+        self._send_packet(struct.pack(b'B', command) + payload, 0)
+
+    def _send_packet(self, payload, seq):
+        data = []
+        while True:
+            chunk, payload = payload[:MAX_PACKET], payload[MAX_PACKET:]
+            data.append(struct.pack(b'<I', len(chunk))[:3] + struct.pack(b'B', seq & 0xff) + chunk)
+            seq += 1
+            if len(chunk) < MAX_PACKET:
+                break
+        try:
+            self._sock.sendall(b''.join(data))
+        except socket.error as e:
+            self._lost(e)
+
+    def _read_packet(self):
+        packet = bytearray()
+        while True:
+            header = self._read(4)
+            length = header[0] | header[1] << 8 | header[2] << 16
+            packet += self._read(length)
+            if length < MAX_PACKET:
+                return packet
+
+    def _read(self, size):
+        buf = self._buffer
+        while len(buf) < size:
+            try:
+                chunk = self._sock.recv(max(65536, size - len(buf)))
+            except socket.error as e:
+                self._lost(e)
+            if not chunk:
+                self._lost('connection closed by searchd')
+            buf += chunk
+
+        data = buf[:size]
+        del buf[:size]
+        return data
+
+    def _lost(self, reason):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        raise OperationalError(2013, 'Lost connection to searchd during query (%s)' % reason)
+
+    def _check_error(self, packet):
+        if packet[0] == 0xff:
+            code = packet[1] | packet[2] << 8
+            pos = 9 if packet[3:4] == b'#' else 3
+            message = bytes(packet[pos:]).decode('utf-8', 'replace')
+            if code in PROGRAMMING_ERRORS:
+                raise ProgrammingError(code, message)
+            raise OperationalError(code, message)
+
+    def _read_ok(self, packet):
+        self._check_error(packet)
+        if packet[0] != 0x00:
+            raise OperationalError(2027, 'Malformed packet')
+
+
+class Cursor(object):
+
+    arraysize = 1
+
+    def __init__(self, connection, backend=None):
+        self.connection = connection
+        self.backend = backend
+        self.description = None
+        self.rowcount = -1
+        self._results = []
+        self._rows = []
+        self._pos = 0
+
+    def execute(self, query, args=None):
+        if args is not None:
+            if isinstance(args, dict):
+                query = query % dict((k, escape(v)) for k, v in args.items())
+            else:
+                query = query % tuple(escape(v) for v in args)
+
+        results, network_time = self.connection.query(query)
+
+        start = time.time()
+        self._results = [(d, self._decode(d, rows) if d else rows, c) for d, rows, c in results]
+        decode_time = time.time() - start
+
+        if self.backend is not None:
+            self.backend.record(rows=sum(len(r) for _, r, _ in self._results),
+                                query_time=network_time + decode_time,
+                                decode_time=decode_time)
+
+        self.nextset()
+        return self.rowcount
+
+    def nextset(self):
+        if not self._results:
+            return None
+        self.description, self._rows, self.rowcount = self._results.pop(0)
+        self._pos = 0
+        return True
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        self._pos += 1
+        return self._rows[self._pos - 1]
+
+    def fetchmany(self, size=None):
+        end = self._pos + (size or self.arraysize)
+        rows = self._rows[self._pos:end]
+        self._pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self._results = self._rows = []
+
+    @staticmethod
+    def _decode(description, packets):
+        converters = []
+        for column in description:
+            if column[1] in INT_TYPES:
+                converters.append(int)
+            elif column[1] in FLOAT_TYPES:
+                converters.append(float)
+            else:
+                converters.append(None)
+
+        rows = []
+        for packet in packets:
+            row = []
+            pos = 0
+            for convert in converters:
+                first = packet[pos]
+                if first == 0xfb:
+                    row.append(None)
+                    pos += 1
+                    continue
+                if first < 0xfb:
+                    start = pos + 1
+                    end = start + first
+                else:
+                    length, start = _lenenc_int(packet, pos)
+                    end = start + length
+                value = bytes(packet[start:end])
+                row.append(convert(value) if convert is not None else value)
+                pos = end
+            rows.append(tuple(row))
+        return rows
+
+
+class Backend(BaseBackend):
+    """
+    Клиент SphinxQL на чистом Python. Не требует сторонних библиотек,
+    разбор строк измеряется отдельно от ожидания сети (decode_time).
+    """
+    name = 'native'
+
+    Error = Error
+    OperationalError = OperationalError
+    ProgrammingError = ProgrammingError
+
+    def connect(self, host, port):
+        return Connection(host, port, backend=self)
+
+    def set_timeout(self, connection, timeout):
+        connection.settimeout(timeout)
+        return True
+
+    def execute(self, cursor, query, args=None):
+        # статистику собирает сам курсор
+        cursor.execute(query, args)
@@ -0,0 +1,25 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import pymysql
+
+from pymysql.constants import CLIENT
+
+from djangosphinx.query.backends.base import BaseBackend
+
+
+class Backend(BaseBackend):
+    """PyMySQL. Чистый Python, строки разбираются во время execute()"""
+    name = 'pymysql'
+
+    Error = pymysql.Error
+    OperationalError = pymysql.OperationalError
+    ProgrammingError = pymysql.ProgrammingError
+
+    def connect(self, host, port):
+        return pymysql.connect(host=host, port=port, charset='utf8', use_unicode=False,
+                               client_flag=CLIENT.MULTI_STATEMENTS | CLIENT.MULTI_RESULTS)
+
+    def set_timeout(self, connection, timeout):
+        connection._sock.settimeout(timeout)
+        return True
@@ -0,0 +1,145 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import time
+
+from threading import Lock
+
+from django.utils.importlib import import_module
+
+__all__ = ['Node', 'RoundRobinBalancer', 'LeastOutstandingBalancer',
+           'LatencyEWMABalancer', 'BALANCERS', 'get_balancer']
+
+
+class Node(object):
+    """
+    Один сервер searchd из SPHINX_NODES
+    """
+    def __init__(self, host, port, weight=1, writer=False):
+        assert weight > 0, 'Node weight must be positive'
+
+        self.host = host
+        self.port = int(port)
+        self.weight = weight
+        self.writer = writer    # запросы к RT-индексам выполняются на этом узле
+
+        self.pool = None
+        self.outstanding = 0    # сколько подключений к узлу сейчас выдано потокам
+        self.latency = None     # EWMA времени выполнения запросов, сек.
+        self.down_until = 0
+
+    def __repr__(self):
+        return '<Node %s:%i>' % (self.host, self.port)
+
+    def is_up(self, now=None):
+        return (now or time.time()) >= self.down_until
+
+
+class Balancer(object):
+    """
+    Выбирает узел для нового подключения. Узлы, помеченные как недоступные,
+    пропускаются до истечения `cooldown` секунд. Если недоступны все узлы,
+    выбирается тот, что должен освободиться раньше остальных.
+    """
+    def __init__(self, nodes, cooldown=30, ewma_alpha=0.3):
+        assert nodes, 'At least one searchd node required'
+
+        self.nodes = list(nodes)
+        self.cooldown = cooldown
+        self.ewma_alpha = ewma_alpha
+        self._lock = Lock()
+
+    def select(self, exclude=()):
+        with self._lock:
+            candidates = [n for n in self.nodes if n not in exclude]
+            if not candidates:
+                return None
+
+            now = time.time()
+            up = [n for n in candidates if n.is_up(now)]
+            if up:
+                node = self._choose(up)
+            else:
+                node = min(candidates, key=lambda n: n.down_until)
+
+            node.outstanding += 1
+            return node
+
+    def acquire(self, node):
+        """Учитывает подключение к узлу, выбранному не балансировщиком"""
+        with self._lock:
+            node.outstanding += 1
+
+    def done(self, node):
+        with self._lock:
+            node.outstanding -= 1
+
+    def mark_down(self, node):
+        with self._lock:
+            node.down_until = time.time() + self.cooldown
+
+    def record(self, node, elapsed):
+        with self._lock:
+            if node.latency is None:
+                node.latency = elapsed
+            else:
+                node.latency += self.ewma_alpha * (elapsed - node.latency)
+
+    def _choose(self, nodes):
+        raise NotImplementedError
+
+
+class RoundRobinBalancer(Balancer):
+    """Плавный взвешенный round-robin (как в nginx)"""
+    def __init__(self, *args, **kwargs):
+        super(RoundRobinBalancer, self).__init__(*args, **kwargs)
+        self._current = dict((n, 0) for n in self.nodes)
+
+    def _choose(self, nodes):
+        total = 0
+        best = None
+        for node in nodes:
+            self._current[node] += node.weight
+            total += node.weight
+            if best is None or self._current[node] > self._current[best]:
+                best = node
+
+        self._current[best] -= total
+        return best
+
+
+class LeastOutstandingBalancer(Balancer):
+    """Узел с наименьшим числом выполняемых запросов с учётом веса"""
+    def _choose(self, nodes):
+        return min(nodes, key=lambda n: float(n.outstanding) / n.weight)
+
+
+class LatencyEWMABalancer(Balancer):
+    """
+    Узел с наименьшей ожидаемой задержкой: EWMA времени ответа,
+    умноженное на количество выполняемых запросов. Узлы, по которым
+    ещё нет статистики, выбираются в первую очередь.
+    """
+    def _choose(self, nodes):
+        return min(nodes, key=lambda n: (n.latency or 0) * (n.outstanding + 1) / n.weight)
+
+
+BALANCERS = dict(
+    round_robin=RoundRobinBalancer,
+    least_outstanding=LeastOutstandingBalancer,
+    latency_ewma=LatencyEWMABalancer,
+)
+
+
+def get_balancer(name, nodes, **kwargs):
+    """
+    Создаёт балансировщик по имени из BALANCERS
+    или по полному пути к классу.
+    """
+    if name in BALANCERS:
+        cls = BALANCERS[name]
+    else:
+        module, attr = name.rsplit('.', 1)
+        cls = getattr(import_module(module), attr)
+
+    return cls(nodes, **kwargs)
@@ -0,0 +1,107 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import time
+
+from threading import Lock
+
+from djangosphinx.signals import breaker_state_changed
+
+__all__ = ['CircuitBreaker']
+
+
+class CircuitBreaker(object):
+    """
+    Предохранитель для запросов к searchd.
+
+    После `threshold` сбоев подряд размыкается (open), и запросы
+    отклоняются сразу, не дожидаясь таймаутов. Через `probe_interval`
+    секунд пропускается один пробный запрос (half-open): если он успешен,
+    предохранитель замыкается (closed), иначе снова размыкается.
+
+    Смена состояния отправляет сигнал `breaker_state_changed`.
+
+    :param threshold: количество сбоев подряд; 0 или None - предохранитель отключен
+    :param probe_interval: через сколько секунд пропустить пробный запрос
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, probe_interval=10):
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._probing = False
+        self._lock = Lock()
+
+    def allow(self):
+        """
+        Можно ли выполнить запрос. Если да, по окончании запроса
+        нужно вызвать success(), failure() или cancel().
+        """
+        if not self.threshold:
+            return True
+
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.probe_interval:
+                    return False
+                changed = self._set_state(self.HALF_OPEN)
+            elif self._probing:
+                # пробный запрос уже выполняется
+                return False
+            else:
+                changed = None
+
+            self._probing = True
+
+        self._notify(changed)
+        return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            changed = self._set_state(self.CLOSED)
+
+        self._notify(changed)
+
+    def cancel(self):
+        """Запрос не дошёл до searchd: не считается ни успехом, ни сбоем"""
+        with self._lock:
+            self._probing = False
+
+    def failure(self):
+        if not self.threshold:
+            return
+
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+
+            changed = None
+            if self.state == self.HALF_OPEN \
+                    or self.state == self.CLOSED and self.failures >= self.threshold:
+                self.opened_at = time.time()
+                changed = self._set_state(self.OPEN)
+
+        self._notify(changed)
+
+    def _set_state(self, state):
+        if state == self.state:
+            return None
+
+        old, self.state = self.state, state
+        return old, state, self.failures
+
+    def _notify(self, changed):
+        if changed is not None:
+            old, new, failures = changed
+            breaker_state_changed.send(sender=self, old_state=old, new_state=new, failures=failures)
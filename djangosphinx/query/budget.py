@@ -0,0 +1,60 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import time
+
+from contextlib import contextmanager
+from threading import local
+
+__all__ = ['SearchTimeout', 'search_budget', 'current_deadline',
+           'earliest', 'remaining']
+
+_budgets = local()
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+@contextmanager
+def search_budget(seconds):
+    """
+    Ограничивает время всех поисковых запросов внутри блока::
+
+        with search_budget(0.3):
+            results = list(qs)
+            related = list(qs2)
+
+    Вложенные бюджеты не могут продлить внешний.
+    """
+    stack = _budgets.__dict__.setdefault('stack', [])
+    stack.append(earliest(current_deadline(), time.time() + seconds))
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def current_deadline():
+    """Момент истечения текущего бюджета потока или None"""
+    stack = getattr(_budgets, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def earliest(*deadlines):
+    deadlines = [d for d in deadlines if d is not None]
+    return min(deadlines) if deadlines else None
+
+
+def remaining(deadline):
+    """
+    Сколько секунд осталось до `deadline`.
+    Выбрасывает SearchTimeout, если время уже вышло.
+    """
+    if deadline is None:
+        return None
+
+    left = deadline - time.time()
+    if left <= 0:
+        raise SearchTimeout('Search time budget exceeded by %.3f sec' % -left)
+    return left
@@ -0,0 +1,489 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import copy
+import hashlib
+import random
+import sys
+import time
+
+from collections import OrderedDict
+from threading import Event, Lock
+
+import six
+
+from django.db import DEFAULT_DB_ALIAS
+
+from djangosphinx.conf import SPHINX_OBJECT_CACHE_SIZE, SPHINX_OBJECT_CACHE_TTL, \
+    SPHINX_OBJECT_CACHE_BACKEND, SPHINX_RESULT_CACHE_SIZE, SPHINX_RESULT_CACHE_BACKEND, \
+    SPHINX_RESULT_CACHE_LEASE, SPHINX_NEGATIVE_CACHE_SIZE, SPHINX_NEGATIVE_CACHE_TTL
+from djangosphinx.query.budget import SearchTimeout, remaining
+from djangosphinx.query.workers import run_refresh
+
+__all__ = ['LRUCache', 'ObjectCache', 'object_cache', 'invalidate_object',
+           'SingleFlight', 'ResultCache', 'result_cache',
+           'NegativeCache', 'negative_cache']
+
+
+class LRUCache(object):
+    """
+    Ограниченный кэш в памяти процесса, общий для всех потоков.
+    При переполнении вытесняются записи, к которым дольше всего не обращались.
+
+    :param max_size: максимальное количество записей
+    :param ttl: время жизни записи в секундах, None - без ограничения
+    """
+    def __init__(self, max_size=1000, ttl=None):
+        assert max_size > 0, 'Cache size must be positive'
+
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._data = OrderedDict()  # ключ -> (момент истечения, значение); в конце - свежие
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                item = self._data.pop(key, None)
+                if item is None:
+                    continue
+                if item[0] is not None and item[0] <= now:
+                    continue
+                self._data[key] = item
+                found[key] = item[1]
+        return found
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, data, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            for key, value in data.iteritems():
+                self._data.pop(key, None)
+                self._data[key] = (expires, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight(object):
+    """
+    Объединяет одновременные вычисления с одним ключом: первый поток
+    выполняет функцию, остальные дожидаются и получают тот же результат
+    (или то же исключение).
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}  # ключ -> [Event, результат, exc_info]
+
+    def do(self, key, func, deadline=None):
+        """
+        :param deadline: момент, после которого ожидающие потоки
+                         выбрасывают SearchTimeout
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [Event(), None, None]
+
+        if not leader:
+            if not call[0].wait(remaining(deadline)):
+                raise SearchTimeout('Search time budget exceeded while waiting for the same query')
+            if call[2] is not None:
+                six.reraise(*call[2])
+            return call[1]
+
+        try:
+            call[1] = func()
+        except:
+            call[2] = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call[0].set()
+
+        return call[1]
+
+
+class ObjectCache(object):
+    """
+    Кэш объектов моделей, получаемых при hydrate: LRU в памяти процесса
+    и, если задан `backend`, кэш Django (общий для процессов) за ним.
+    Записи сбрасываются сигналами post_save/post_delete моделей с SphinxSearch.
+    Объекты из разных БД хранятся отдельно (`using` - псевдоним БД).
+
+    :param max_size: размер LRU в памяти процесса
+    :param ttl: время жизни записей в секундах
+    :param backend: название кэша из CACHES или None
+    """
+    def __init__(self, max_size=10000, ttl=60, backend=None):
+        self.local = LRUCache(max_size, ttl)
+        self.ttl = ttl
+        self.backend = backend
+        self._backend = None
+
+        self.stats = dict(
+            hits=0,         # объект найден в памяти процесса
+            shared_hits=0,  # объект найден в кэше Django
+            misses=0,       # объект пришлось запрашивать из БД
+        )
+
+    def get_many(self, model, pks, using=DEFAULT_DB_ALIAS):
+        """
+        Объекты модели из кэша
+
+        :returns: {ID: объект} для найденных объектов
+        """
+        keys = dict((self._make_key(model, pk, using), pk) for pk in pks)
+
+        cached = self.local.get_many(keys)
+        self.stats['hits'] += len(cached)
+
+        missed = [key for key in keys if key not in cached]
+        if missed and self.backend is not None:
+            shared = self._get_backend().get_many(missed)
+            self.local.set_many(shared)
+            self.stats['shared_hits'] += len(shared)
+            cached.update(shared)
+
+        self.stats['misses'] += len(keys) - len(cached)
+
+        # в памяти процесса хранятся сами объекты: отдаём полные копии (вместе
+        # с _state и кэшем связанных объектов), чтобы изменения одного запроса
+        # не попали в другие
+        return dict((keys[key], copy.deepcopy(obj)) for key, obj in cached.iteritems())
+
+    def set_many(self, model, objects, using=DEFAULT_DB_ALIAS):
+        """Сохраняет объекты {ID: объект} в кэш"""
+        data = dict((self._make_key(model, pk, using), copy.deepcopy(obj)) for pk, obj in objects.iteritems())
+        self.local.set_many(data)
+        if self.backend is not None:
+            self._get_backend().set_many(data, self.ttl)
+
+    def invalidate(self, model, pk, using=DEFAULT_DB_ALIAS):
+        key = self._make_key(model, pk, using)
+        self.local.delete(key)
+        if self.backend is not None:
+            self._get_backend().delete(key)
+
+    def clear(self):
+        """Очищает кэш в памяти процесса, кэш Django не затрагивается"""
+        self.local.clear()
+
+    def _get_backend(self):
+        return _get_backend(self)
+
+    @staticmethod
+    def _make_key(model, pk, using):
+        opts = model._meta.concrete_model._meta
+        return 'djangosphinx:object:%s:%s.%s:%s' % (using, opts.app_label, opts.object_name.lower(), pk)
+
+
+class ResultCache(object):
+    """
+    Кэш результатов поисковых запросов (ID документов, атрибуты, метаданные):
+    LRU в памяти процесса и, если задан `backend`, кэш Django за ним.
+
+    В ключ записи входят версии индексов запроса. После изменения индекса
+    (см. bump()) ключи меняются, и устаревшие записи просто перестают
+    находиться, пока не будут вытеснены.
+
+    Промахи по одному ключу выполняются одним потоком процесса (fetch()),
+    а если задан `lease` - одним процессом: он получает блокировку в кэше
+    Django на `lease` секунд, остальные процессы ждут появления результата.
+
+    :param max_size: размер LRU в памяти процесса
+    :param backend: название кэша из CACHES или None
+    :param lease: время блокировки в кэше Django в секундах или None
+    """
+    # как часто процессы, ожидающие результата, проверяют кэш Django
+    POLL_INTERVAL = 0.05
+    # время жизни версий индексов в кэше Django: timeout=None в Django 1.5
+    # означает время по-умолчанию (300 сек.), а больше 30 дней memcached
+    # воспринимает как абсолютный момент времени
+    VERSION_TIMEOUT = 30 * 24 * 3600
+
+    def __init__(self, max_size=1000, backend=None, lease=None):
+        self.local = LRUCache(max_size)
+        self.backend = backend
+        self.lease = lease
+        self._backend = None
+        self._versions = {}  # индекс -> версия, если кэша Django нет
+        self._lock = Lock()
+        self._flight = SingleFlight()
+        self._refreshing = set()  # ключи, обновляемые в фоне
+
+        self.stats = dict(
+            hits=0,         # найден неустаревший результат
+            stale_hits=0,   # возвращён устаревший результат, обновляется в фоне
+            shared_hits=0,  # результат взят из кэша Django
+            misses=0,       # запрос пришлось выполнить
+            waits=0,        # результат выполнения в другом процессе дождались
+            dropped=0,      # обновление пропущено: все потоки обновлений заняты
+        )
+
+    def make_key(self, query, args, indexes, kind='result'):
+        """
+        Ключ записи для запроса `query` с аргументами `args` к индексам `indexes`.
+        Пробельные символы в запросе нормализуются.
+        """
+        query = ' '.join(query.split())
+        versions = self.get_versions(indexes)
+        data = repr((kind, query, tuple(args or ()), sorted(versions.items())))
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        return 'djangosphinx:%s:%s' % (kind, hashlib.md5(data).hexdigest())
+
+    def get(self, key):
+        """Значение, если оно есть в кэше и не устарело, иначе None"""
+        entry = self._get_entry(key)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def set(self, key, value, ttl, stale_ttl=None):
+        """
+        Сохраняет значение на `ttl` секунд; с `stale_ttl` устаревшее значение
+        хранится, пока с момента сохранения не пройдёт `stale_ttl` секунд.
+        """
+        now = time.time()
+        lifetime = max(ttl, stale_ttl or 0)
+        self.local.set(key, (now + ttl, value), lifetime)
+        if self.backend is not None:
+            # в кэше Django хранится и момент истечения записи
+            self._get_backend().set(key, (now + lifetime, now + ttl, value), lifetime)
+
+    def fetch(self, key, func, ttl, deadline=None, stale_ttl=None, refresh=None):
+        """
+        Значение из кэша или результат func(), сохраняемый в кэш на `ttl` секунд.
+        Одновременные промахи по ключу выполняют func() один раз.
+
+        С `stale_ttl` устаревшее значение возвращается сразу, а новое получается
+        в фоновом потоке функцией `refresh` (по-умолчанию - func), которая
+        должна быть безопасна для вызова из другого потока.
+
+        :param deadline: момент, после которого ожидание результата прекращается
+        """
+        entry = self._get_entry(key)
+        if entry is not None:
+            fresh_until, value = entry
+            if fresh_until > time.time():
+                self.stats['hits'] += 1
+                return value
+            if stale_ttl:
+                self.stats['stale_hits'] += 1
+                self._revalidate(key, refresh or func, ttl, stale_ttl)
+                return value
+
+        self.stats['misses'] += 1
+        return self._flight.do(key, lambda: self._fetch(key, func, ttl, deadline, stale_ttl), deadline)
+
+    def _get_entry(self, key):
+        """(момент устаревания, значение) из памяти процесса или кэша Django"""
+        entry = self.local.get(key)
+        if entry is not None or self.backend is None:
+            return entry
+
+        item = self._get_backend().get(key)
+        if item is None:
+            return None
+
+        expires, fresh_until, value = item
+        self.local.set(key, (fresh_until, value), expires - time.time())
+        self.stats['shared_hits'] += 1
+        return fresh_until, value
+
+    def _fetch(self, key, func, ttl, deadline, stale_ttl=None):
+        locked = False
+        if self.lease and self.backend is not None:
+            lock_key = '%s:lock' % key
+            locked = self._get_backend().add(lock_key, 1, self.lease)
+            if not locked:
+                value = self._wait(key, deadline)
+                if value is not None:
+                    self.stats['waits'] += 1
+                    return value
+
+        try:
+            value = func()
+            self.set(key, value, ttl, stale_ttl)
+        finally:
+            if locked:
+                self._get_backend().delete(lock_key)
+
+        return value
+
+    def _revalidate(self, key, func, ttl, stale_ttl):
+        """
+        Обновляет устаревшее значение в фоновом потоке, одно обновление на ключ.
+        Если свободного потока нет, обновление пропускается: его выполнит
+        одно из следующих обращений.
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._flight.do(key, lambda: self._fetch(key, func, ttl, None, stale_ttl))
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        if not run_refresh(refresh):
+            with self._lock:
+                self._refreshing.discard(key)
+            self.stats['dropped'] += 1
+
+    def _wait(self, key, deadline):
+        """Ждёт результата, который получает другой процесс, не дольше lease"""
+        backend = self._get_backend()
+        until = time.time() + self.lease
+        while time.time() < until:
+            time.sleep(min(self.POLL_INTERVAL, remaining(deadline) or self.POLL_INTERVAL))
+            item = backend.get(key)
+            if item is not None and item[1] > time.time():
+                expires, fresh_until, value = item
+                self.local.set(key, (fresh_until, value), expires - time.time())
+                return value
+        return None
+
+    def get_versions(self, indexes):
+        """Текущие версии индексов, {индекс: версия}"""
+        if self.backend is None:
+            return dict((index, self._versions.get(index, 0)) for index in indexes)
+
+        backend = self._get_backend()
+        keys = dict((self._version_key(index), index) for index in indexes)
+        versions = backend.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                # версия могла быть вытеснена из кэша
+                backend.add(key, self._new_version(), self.VERSION_TIMEOUT)
+                versions[key] = backend.get(key)
+        return dict((keys[key], version) for key, version in versions.iteritems())
+
+    def bump(self, *indexes):
+        """
+        Меняет версии индексов, делая недействительными все результаты запросов
+        к ним. Вызывается при изменении RT-индексов и после ротации индексов.
+        """
+        with self._lock:
+            for index in indexes:
+                self._versions[index] = self._versions.get(index, 0) + 1
+
+        if self.backend is not None:
+            backend = self._get_backend()
+            for index in indexes:
+                key = self._version_key(index)
+                try:
+                    backend.incr(key)
+                except ValueError:
+                    backend.set(key, self._new_version(), self.VERSION_TIMEOUT)
+
+    def clear(self):
+        """Очищает кэш в памяти процесса, кэш Django не затрагивается"""
+        self.local.clear()
+
+    def _get_backend(self):
+        return _get_backend(self)
+
+    @staticmethod
+    def _version_key(index):
+        return 'djangosphinx:version:%s' % index
+
+    @staticmethod
+    def _new_version():
+        # новая версия начинается с момента времени, чтобы не совпасть с версией
+        # старых записей; случайная часть различает версии, созданные в одну мс
+        return int(time.time() * 1000) << 20 | random.getrandbits(20)
+
+
+class NegativeCache(object):
+    """
+    Запросы, не нашедшие ни одного документа: LRU ограниченного размера
+    с коротким временем жизни, хранящее только ключи. В ключ входят версии
+    индексов из `versions` (ResultCache), поэтому изменение индекса
+    сбрасывает и записи о запросах к нему.
+
+    :param versions: ResultCache, хранящий версии индексов
+    :param max_size: количество запоминаемых запросов
+    :param ttl: время жизни записи в секундах
+    """
+    def __init__(self, versions, max_size=10000, ttl=30):
+        self.versions = versions
+        self.local = LRUCache(max_size, ttl)
+
+        self.stats = dict(
+            hits=0,     # запрос не отправлялся в searchd
+            stored=0,   # запомнено запросов без результатов
+        )
+
+    def make_key(self, query, args, indexes):
+        """
+        Ключ запроса `query` с аргументами `args` к индексам `indexes`.
+        Пробельные символы нормализуются и в строковых аргументах (тексте MATCH).
+        """
+        args = [' '.join(arg.split()) if isinstance(arg, six.string_types) else arg for arg in args or ()]
+        # хватает дайджеста: строка ключа нужна только кэшу Django
+        return self.versions.make_key(query, args, indexes, kind='empty').rsplit(':', 1)[1]
+
+    def __contains__(self, key):
+        if self.local.get(key) is None:
+            return False
+        self.stats['hits'] += 1
+        return True
+
+    def add(self, key):
+        self.local.set(key, True)
+        self.stats['stored'] += 1
+
+    def clear(self):
+        self.local.clear()
+
+
+def _get_backend(cache):
+    if cache._backend is None:
+        from django.core.cache import get_cache
+        cache._backend = get_cache(cache.backend)
+    return cache._backend
+
+
+object_cache = ObjectCache(SPHINX_OBJECT_CACHE_SIZE, SPHINX_OBJECT_CACHE_TTL, SPHINX_OBJECT_CACHE_BACKEND)
+
+
+def invalidate_object(sender, instance, using=DEFAULT_DB_ALIAS, **kwargs):
+    """Обработчик post_save/post_delete моделей с SphinxSearch"""
+    object_cache.invalidate(sender, instance.pk, using)
+
+
+result_cache = ResultCache(SPHINX_RESULT_CACHE_SIZE, SPHINX_RESULT_CACHE_BACKEND, SPHINX_RESULT_CACHE_LEASE)
+
+negative_cache = NegativeCache(result_cache, SPHINX_NEGATIVE_CACHE_SIZE, SPHINX_NEGATIVE_CACHE_TTL)
@@ -0,0 +1,187 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import time
+
+from collections import deque
+from threading import Condition
+
+__all__ = ['ConnectionPool', 'PoolTimeout']
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(object):
+    """
+    Обёртка над подключением к searchd, хранящая время его создания
+    и последнего возврата в пул.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = self.last_used = time.time()
+        self.checkouts = 0
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool(object):
+    """
+    Ограниченный пул подключений к searchd, общий для всех потоков процесса.
+
+    :param connect: функция без аргументов, открывающая новое подключение
+    :param max_size: максимальное количество открытых подключений
+    :param timeout: сколько секунд ждать освобождения подключения, если пул исчерпан
+    :param max_idle: через сколько секунд простоя подключение закрывается
+    :param max_lifetime: максимальное время жизни подключения в секундах
+    """
+    def __init__(self, connect, max_size=10, timeout=5.0, max_idle=None, max_lifetime=None):
+        assert max_size > 0, 'Pool size must be positive'
+
+        self._connect = connect
+        self._idle = deque()  # справа - подключения, вернувшиеся последними
+        self._size = 0  # открытые подключения, в т.ч. выданные потокам
+        self._cond = Condition()
+
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+
+        self.stats = dict(
+            hits=0,         # выдано уже открытое подключение
+            misses=0,       # пришлось открывать новое
+            waits=0,        # сколько раз ждали освобождения подключения
+            wait_time=0.0,  # суммарное время ожидания, сек.
+            timeouts=0,     # сколько раз так и не дождались
+            evicted=0,      # закрыто по max_idle/max_lifetime
+        )
+
+    def get(self, timeout=None):
+        """
+        Выдаёт подключение из пула. Если все подключения заняты, ждёт
+        не дольше `timeout` секунд, затем выбрасывает PoolTimeout.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        with self._cond:
+            self._evict_idle()
+
+            if not self._idle and self._size >= self.max_size:
+                start = time.time()
+                deadline = start + timeout
+                self.stats['waits'] += 1
+                try:
+                    while not self._idle and self._size >= self.max_size:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.stats['timeouts'] += 1
+                            raise PoolTimeout('No free searchd connection in %.2f sec (pool size %i)' % (timeout, self.max_size))
+                        self._cond.wait(remaining)
+                finally:
+                    self.stats['wait_time'] += time.time() - start
+
+            while self._idle:
+                conn = self._idle.pop()
+                if self._expired(conn):
+                    self._drop(conn)
+                    continue
+                self.stats['hits'] += 1
+                conn.checkouts += 1
+                return conn
+
+            self._size += 1
+            self.stats['misses'] += 1
+
+        # подключаемся вне блокировки, чтобы не задерживать остальные потоки
+        try:
+            conn = PooledConnection(self._connect())
+            conn.checkouts += 1
+            return conn
+        except:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def put(self, conn):
+        """Возвращает подключение в пул"""
+        with self._cond:
+            if self._expired(conn):
+                self._drop(conn)
+            else:
+                conn.last_used = time.time()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def discard(self, conn):
+        """Закрывает сломанное подключение, освобождая место в пуле"""
+        conn.close()
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def fill(self, count):
+        """
+        Заранее открывает подключения, пока их не станет `count`
+        (но не больше max_size).
+
+        :returns: количество открытых подключений
+        """
+        opened = 0
+        while True:
+            with self._cond:
+                if self._size >= min(count, self.max_size):
+                    return opened
+                self._size += 1
+
+            try:
+                conn = PooledConnection(self._connect())
+            except:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+
+            self.put(conn)
+            opened += 1
+
+    def clear(self):
+        """Закрывает все простаивающие подключения"""
+        with self._cond:
+            while self._idle:
+                conn = self._idle.pop()
+                conn.close()
+                self._size -= 1
+            self._cond.notify_all()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def _expired(self, conn):
+        return self.max_lifetime is not None \
+               and time.time() - conn.created >= self.max_lifetime
+
+    def _drop(self, conn):
+        conn.close()
+        self._size -= 1
+        self.stats['evicted'] += 1
+
+    def _evict_idle(self):
+        if self.max_idle is None:
+            return
+
+        now = time.time()
+        while self._idle and now - self._idle[0].last_used >= self.max_idle:
+            self._drop(self._idle.popleft())
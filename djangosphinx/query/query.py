@@ -3,111 +3,444 @@ from __future__ import unicode_literals
 
 __author__ = 'ego'
 
-import MySQLdb
+import heapq
+import os
 import re
+import time
 
-from threading import local
+from functools import partial
+from itertools import islice
+from threading import local, Thread
 
-from django.core.signals import request_finished
+from django.core.signals import request_started, request_finished
 from django.utils.encoding import force_unicode
 
-from djangosphinx.conf import SEARCHD_SETTINGS, SPHINX_ESCAPE_FIELD_SEARCH_OPERATOR
+from djangosphinx.conf import SEARCHD_SETTINGS, SPHINX_ESCAPE_FIELD_SEARCH_OPERATOR, \
+    SPHINX_POOL_SIZE, SPHINX_POOL_TIMEOUT, SPHINX_POOL_MAX_IDLE, \
+    SPHINX_CONN_MAX_AGE, SPHINX_POOL_PREWARM, \
+    SPHINX_PING_IDLE_TIME, SPHINX_BALANCER, SPHINX_NODE_COOLDOWN, \
+    SPHINX_NODE_RETRIES, SPHINX_NODE_RETRY_DELAY, SPHINX_DB_BACKEND, \
+    SPHINX_BREAKER_THRESHOLD, SPHINX_BREAKER_PROBE_INTERVAL, SPHINX_FETCH_SIZE
+from djangosphinx.query.backends import get_backend
+from djangosphinx.query.balancer import Node, get_balancer
+from djangosphinx.query.breaker import CircuitBreaker
+from djangosphinx.query.budget import SearchTimeout, earliest, remaining
+from djangosphinx.query.pool import ConnectionPool, PoolTimeout
+from djangosphinx.query.workers import in_worker, run_async
 
 
 class ConnectionError(Exception):
    pass
 
 
+class CircuitOpen(ConnectionError):
+    """Запрос отклонён: предохранитель разомкнут после серии сбоев searchd"""
+
+
+class PoolExhausted(ConnectionError):
+    """Все подключения пула к узлу заняты дольше SPHINX_POOL_TIMEOUT"""
+
+
+class _ResponseTimeout(SearchTimeout):
+    """Бюджет времени истёк в ожидании ответа на уже отправленный запрос"""
+
+
 class ConnectionHandler(object):
-    def __init__(self):
+    """
+    Выдаёт потокам подключения к узлам searchd из общих пулов.
+
+    Поток удерживает полученное подключение до вызова `release()`,
+    поэтому SELECT и следующий за ним SHOW META выполняются в одной сессии.
+    Узел для нового подключения выбирает балансировщик SPHINX_BALANCER.
+    """
+    # запросы, которые можно безопасно повторить на новом подключении
+    _replayable = re.compile(r'^\s*(SELECT|CALL|SHOW)\b', re.I)
+    # ...кроме тех, что читают состояние предыдущего запроса в сессии
+    _session_bound = re.compile(r'^\s*SHOW\s+(META|WARNINGS)\b', re.I)
+
+    def __init__(self, nodes=None, balancer=None, backend=None):
         self._connections = local()
+        self._nodes = nodes
+        self._balancer_name = balancer or SPHINX_BALANCER
+        self._balancer = None
+        self._backend_name = backend or SPHINX_DB_BACKEND
+        self._backend = None
+        self._pid = None
+        self._warmed_pid = None
+
+        self.breaker = CircuitBreaker(SPHINX_BREAKER_THRESHOLD, SPHINX_BREAKER_PROBE_INTERVAL)
+
+    def _get_backend(self):
+        if self._backend is None:
+            self._backend = get_backend(self._backend_name)
+        return self._backend
+
+    backend = property(_get_backend)
+
+    def _get_balancer(self):
+        if self._balancer is None or self._pid != os.getpid():
+            # после fork() подключения родительского процесса не используются:
+            # их сокеты общие с родителем
+            self._connections = local()
+            self._pid = os.getpid()
+
+            nodes = []
+            for opts in self._nodes or SEARCHD_SETTINGS['nodes']:
+                node = Node(**opts)
+                node.pool = ConnectionPool(partial(self._connect, node),
+                                           max_size=SPHINX_POOL_SIZE,
+                                           timeout=SPHINX_POOL_TIMEOUT,
+                                           max_idle=SPHINX_POOL_MAX_IDLE,
+                                           max_lifetime=SPHINX_CONN_MAX_AGE or None)
+                nodes.append(node)
+
+            self._balancer = get_balancer(self._balancer_name, nodes, cooldown=SPHINX_NODE_COOLDOWN)
+        return self._balancer
+
+    balancer = property(_get_balancer)
+
+    def _connect(self, node):
+        return self.backend.connect(node.host, node.port)
+
+    def warm_up(self, count=None):
+        """
+        Открывает заранее `count` (по-умолчанию SPHINX_POOL_PREWARM)
+        подключений к каждому узлу. Недоступные узлы исключаются из балансировки.
+        """
+        if count is None:
+            count = SPHINX_POOL_PREWARM
+
+        opened = 0
+        for node in self.balancer.nodes:
+            try:
+                opened += node.pool.fill(count)
+            except self.backend.OperationalError:
+                self.balancer.mark_down(node)
+        return opened
+
+    def warm_up_async(self, count=None):
+        """Запускает warm_up() в фоновом потоке, один раз для процесса"""
+        if self._warmed_pid == os.getpid():
+            return
+        self._warmed_pid = os.getpid()
+
+        thread = Thread(target=self.warm_up, args=(count,), name='sphinx-warm-up')
+        thread.daemon = True
+        thread.start()
+
+    def _checkout(self, node):
+        conn = node.pool.get()
+
+        # пингуем только подключения, долго пролежавшие в пуле
+        if conn.checkouts > 1 and SPHINX_PING_IDLE_TIME is not None \
+                and time.time() - conn.last_used >= SPHINX_PING_IDLE_TIME:
+            try:
+                conn.connection.ping()
+            except self.backend.OperationalError:
+                node.pool.discard(conn)
+                node.pool.clear()
+                conn = node.pool.get()
+
+        return conn
+
+    def _held(self):
+        if self._pid != os.getpid():
+            self._get_balancer()
+        return getattr(self._connections, 'sphinx_database_connection', None)
 
     def _connection(self):
-        if hasattr(self._connections, 'sphinx_database_connection'):
-            return getattr(self._connections, 'sphinx_database_connection')
+        conn = self._held()
+        if conn is not None:
+            return conn.connection
 
-        conn = MySQLdb.connect(host=SEARCHD_SETTINGS['sphinx_host'], port=SEARCHD_SETTINGS['sphinx_port'], charset='utf8', use_unicode=False)
-        setattr(self._connections, 'sphinx_database_connection', conn)
-        return conn
+        tried = []
+        while True:
+            node = self.balancer.select(exclude=tried)
+            if node is None:
+                raise ConnectionError('All searchd nodes are unavailable: %s' % ', '.join(map(repr, tried)))
+
+            try:
+                return self._attach(node)
+            except self.backend.OperationalError:
+                tried.append(node)
 
     connection = property(_connection)
 
-    def cursor(self):
+    def _attach(self, node):
+        """Выдаёт потоку подключение к узлу, уже учтённому балансировщиком"""
+        balancer = self.balancer
         try:
-            self.connection.ping()
-        except MySQLdb.OperationalError:
-            self.close()
+            conn = self._checkout(node)
+        except PoolTimeout as e:
+            balancer.done(node)
+            raise PoolExhausted(*e.args)
+        except self.backend.OperationalError:
+            balancer.done(node)
+            balancer.mark_down(node)
+            raise
+
+        conn.node = node
+        setattr(self._connections, 'sphinx_database_connection', conn)
+        return conn.connection
+
+    def _get_writers(self):
+        nodes = self.balancer.nodes
+        return [node for node in nodes if node.writer] or nodes
+
+    writers = property(_get_writers)
 
+    def cursor(self):
         return self.connection.cursor()
 
-    def close(self): # закрывает подключение к Sphinx
-        if hasattr(self._connections, 'sphinx_database_connection'):
-            conn = getattr(self._connections, 'sphinx_database_connection')
+    def execute(self, query, args=None, deadline=None):
+        """
+        Выполняет запрос, не проверяя подключение заранее.
+
+        Если подключение оказалось разорванным, оно закрывается, и запрос,
+        не изменяющий данные, повторяется на новом подключении, но не более
+        SPHINX_NODE_RETRIES раз. Если разорвалось свежее подключение, узел
+        исключается из балансировки, и повтор уходит на другой узел.
+
+        Сбои подключения и истечение времени во время ожидания ответа
+        учитываются предохранителем; пока он разомкнут, сразу
+        выбрасывается CircuitOpen. Истечение времени до отправки запроса
+        и нехватка подключений в пуле сбоями searchd не считаются.
+
+        :param deadline: момент (time.time()), после которого выбрасывается
+                         SearchTimeout. Если драйвер позволяет, на это время
+                         ограничивается и чтение из сокета.
+        """
+        remaining(deadline)
+
+        if not self.breaker.allow():
+            raise CircuitOpen('searchd is unavailable after %i failures, next probe in %.1f sec' % (
+                self.breaker.failures,
+                max(self.breaker.opened_at + self.breaker.probe_interval - time.time(), 0)))
+
+        try:
+            cursor = self._execute(query, args, deadline)
+        except _ResponseTimeout:
+            self.breaker.failure()
+            raise
+        except (PoolExhausted, SearchTimeout):
+            # запрос до searchd не дошёл
+            self.breaker.cancel()
+            raise
+        except (self.backend.OperationalError, ConnectionError):
+            self.breaker.failure()
+            raise
+        except Exception:
+            # searchd ответил, пусть и ошибкой
+            self.breaker.success()
+            raise
+
+        self.breaker.success()
+        return cursor
+
+    def execute_write(self, query, args=None):
+        """
+        Выполняет запрос, изменяющий RT-индекс (INSERT, REPLACE, DELETE), на
+        каждом узле с writer=True, а если таких нет - на всех узлах, по очереди.
+        Балансировщик не участвует, и запрос не повторяется. Подключения
+        освобождаются сразу.
+
+        :returns: количество изменённых документов на первом узле
+        """
+        assert self._held() is None, 'Release the connection before writing'
+
+        count = None
+        for node in self.writers:
+            self.balancer.acquire(node)
+            self._attach(node)
+            try:
+                cursor = self.execute(query, args)
+                if count is None:
+                    count = cursor.rowcount
+            finally:
+                self.release()
+        return count
+
+    def _execute(self, query, args, deadline):
+        attempt = 0
+        while True:
+            timeout = remaining(deadline)
+            cursor = self.cursor()
+            conn = self._held()
+            timed = timeout is not None and self.backend.set_timeout(conn.connection, timeout)
+            start = time.time()
+            try:
+                self.backend.execute(cursor, query, args)
+            except self.backend.OperationalError as e:
+                if not self.backend.is_disconnect(e):
+                    raise
+
+                node = conn.node
+                self.close()
+
+                if deadline is not None and time.time() >= deadline:
+                    # не дождались ответа - это не сбой узла
+                    raise _ResponseTimeout('Search time budget exceeded: %s' % (e.args,))
+
+                # скорее всего, searchd был перезапущен, и остальные
+                # простаивающие подключения тоже мертвы
+                node.pool.clear()
+                if conn.checkouts == 1:
+                    self.balancer.mark_down(node)
+
+                if attempt >= SPHINX_NODE_RETRIES \
+                        or not self._replayable.match(query) or self._session_bound.match(query):
+                    raise
+
+                if attempt:
+                    time.sleep(min(SPHINX_NODE_RETRY_DELAY * 2 ** (attempt - 1), 1.0))
+                attempt += 1
+            else:
+                self.balancer.record(conn.node, time.time() - start)
+                return cursor
+            finally:
+                # и после ошибки подключение вернётся в пул без ограничения времени
+                if timed and self._held() is conn:
+                    self.backend.set_timeout(conn.connection, None)
+
+    def release(self): # возвращает подключение в пул
+        conn = self._held()
+        if conn is not None:
+            delattr(self._connections, 'sphinx_database_connection')
 
-            conn.close()
+            self.balancer.done(conn.node)
+            conn.node.pool.put(conn)
 
+    def close(self): # закрывает подключение к Sphinx
+        conn = self._held()
+        if conn is not None:
             delattr(self._connections, 'sphinx_database_connection')
 
+            self.balancer.done(conn.node)
+            conn.node.pool.discard(conn)
+
+    def stats(self):
+        """
+        Счётчики пулов по узлам: hits, misses, waits, wait_time, timeouts, evicted,
+        текущее количество открытых (size) и свободных (idle) подключений,
+        а так же состояние узла (up, outstanding, latency)
+        """
+        stats = {}
+        now = time.time()
+        for node in self.balancer.nodes:
+            pool = node.pool
+            s = stats['%s:%i' % (node.host, node.port)] = pool.stats.copy()
+            s.update(size=pool.size, idle=pool.idle,
+                     up=node.is_up(now), outstanding=node.outstanding, latency=node.latency)
+        return stats
+
 
 conn_handler = ConnectionHandler()
 
 
 def close_sphinx_connection(**kwargs):
-    conn_handler.close()
+    if SPHINX_CONN_MAX_AGE == 0:
+        conn_handler.close()
+        for node in conn_handler.balancer.nodes:
+            node.pool.clear()
+    else:
+        # подключение не закрывается, а возвращается в пул
+        conn_handler.release()
 
 request_finished.connect(close_sphinx_connection)
 
 
+def warm_up_connections(**kwargs):
+    if SPHINX_POOL_PREWARM:
+        conn_handler.warm_up_async()
+
+# в каждом процессе (в т.ч. после fork) подключения открываются
+# при первом запросе, не задерживая его
+request_started.connect(warm_up_connections)
+
+
 class SphinxQuery(object):
-    _arr_regexp = re.compile(r'^([a-z]+)\[(\d+)\]', re.I)
+    """
+    Результаты одного запроса SphinxQL.
 
-    def __init__(self, query=None, args=None):
+    Если передан `meta_query` - пара (запрос, аргументы), - SHOW META не
+    отправляется вместе с запросом: метаданные (total_found, time, words)
+    запрашиваются отдельно через `meta_query`, только если они понадобятся.
+    Позиции колонок (`fields`) всегда берутся из описания курсора.
+    """
+    def __init__(self, query=None, args=None, deadline=None, meta_query=None):
 
         self._query = query
         self._query_args = args
-        self._result = None
+        self._deadline = deadline
+        self._meta_query = meta_query
+        self._rows = None
         self._meta = None
 
-        self._result_cache = []
-
-        self.cursor = None
+        self.description = None
 
     def __iter__(self):
-        return iter(self.next())
-
-    def next(self):
-        if self.cursor is None:
+        # итерация идёт по самим строкам, без вызова next() на каждую
+        if self._rows is None:
             self._get_results()
 
-        row = self.cursor.fetchone()
+        return self._rows
 
-        if not row:
-            raise StopIteration
+    def next(self):
+        return next(iter(self))
 
-        return row
+    def fetchmany(self, size):
+        """Следующие `size` строк результата одним списком"""
+        return list(islice(iter(self), size))
 
     def query(self, query, args=None):
         return self._clone(_query=force_unicode(query), _query_args=args)
 
     def count(self, ):
-        if self._meta is None:
-            self._get_meta()
-
-        return self._meta['total_found']
+        return self.metadata()['total_found']
 
     def metadata(self):
         if self._meta is None:
-            self._get_meta()
+            if self._meta_query is None:
+                self._get_results()
+            else:
+                self._meta = self._get_meta()
 
         return self._meta.copy()
 
     meta = property(metadata)
 
+    def _get_fields(self):
+        if self._rows is None:
+            self._get_results()
+
+        return self._field_positions()
+
+    fields = property(_get_fields)
+
+    def snapshot(self):
+        """
+        Результаты запроса для кэша: (описание колонок, строки, метаданные),
+        метаданные - None, если они ещё не получены. Выполняет запрос,
+        если он ещё не выполнялся; строки остаются доступны для итерации.
+        """
+        if self._rows is None:
+            self._get_results()
+
+        rows = list(self._rows)
+        self._rows = iter(rows)
+        return self.description, rows, self._meta
+
+    def restore(self, snapshot):
+        """Подставляет результаты, сохранённые snapshot(), вместо выполнения запроса"""
+        self.description, rows, self._meta = snapshot
+        self._rows = iter(rows)
+        return self
+
     def _clone(self, **kwargs):
         q = self.__class__()
         q.__dict__.update(self.__dict__.copy())
 
-        q._result = None
+        q._rows = None
         q._meta = None
         q._query = None
 
@@ -117,34 +450,85 @@ class SphinxQuery(object):
         return q
 
     def _get_results(self):
-        assert self._query is not None, 'Query String is empty'
+        self.fetch_many([self])
+
+    @classmethod
+    def fetch_many(cls, queries):
+        """
+        Выполняет запросы пакетом (multi-query): все SELECT вместе с их
+        SHOW META отправляются одним multi-statement запросом, и searchd
+        может разделить общую работу между ними. Результаты и метаданные
+        раскладываются по переданным SphinxQuery.
+        """
+        queries = list(queries)
+        for start in range(0, len(queries), cls.MAX_BATCH):
+            cls._fetch_batch(queries[start:start + cls.MAX_BATCH])
+
+    # searchd выполняет не больше 32 запросов в одном пакете,
+    # а на каждую выборку приходится два: SELECT и SHOW META
+    MAX_BATCH = 16
+
+    @classmethod
+    def _fetch_batch(cls, queries):
+        statements = []
+        args = []
+        for q in queries:
+            assert q._query is not None, 'Query String is empty'
+
+            if SPHINX_ESCAPE_FIELD_SEARCH_OPERATOR:
+                q._query_args = [re.sub(r"(@)", r"\\\1", arg) for arg in q._query_args]
+
+            statements.append(q._query if q._meta_query else '%s; SHOW META' % q._query)
+            args.extend(q._query_args or [])
+
+        deadline = earliest(*[q._deadline for q in queries])
 
-        if SPHINX_ESCAPE_FIELD_SEARCH_OPERATOR:
-            self._query_args = [re.sub(r"(@)", r"\\\1", arg) for arg in self._query_args]
-
-        self.cursor = conn_handler.cursor()
-        self.cursor.execute(self._query, self._query_args)
+        try:
+            cursor = conn_handler.execute('; '.join(statements), args, deadline)
+            results = conn_handler.backend.results(cursor)
+
+            fetched = []
+            for q in queries:
+                next(results)
+                description = cursor.description
+                rows = cls._read_rows(cursor)
+
+                meta = None
+                if not q._meta_query:
+                    next(results)
+                    meta = cursor.fetchall()
+                fetched.append((description, rows, meta))
+        finally:
+            conn_handler.release()
+
+        for q, (description, rows, meta) in zip(queries, fetched):
+            q.description = description
+            q._rows = iter(rows)
+            if meta is not None:
+                q._meta = q._parse_meta(meta)
 
     def _get_meta(self):
-        if not self._result:
-            self._get_results()
-
-        _meta = dict()
-        c = conn_handler.cursor()
-        c.execute('SHOW META')
+        query, args = self._meta_query
+        return SphinxQuery(query, args, self._deadline).metadata()
 
+    @staticmethod
+    def _read_rows(cursor):
+        """Читает все строки набора результатов блоками по SPHINX_FETCH_SIZE"""
+        rows = []
         while True:
-            row = c.fetchone()
+            block = conn_handler.backend.fetchmany(cursor, SPHINX_FETCH_SIZE)
+            rows.extend(block)
+            if len(block) < SPHINX_FETCH_SIZE:
+                return rows
 
-            if not row:
-                break
+    def _parse_meta(self, rows):
+        _meta = dict()
 
-            key = row[0]
-            val = row[1]
-            m = re.match(self._arr_regexp, key)
-            if m:
-                key, v = m.groups()
-                _meta.setdefault(key, {})[v] = val
+        for key, val in rows:
+            # keyword[0], hits[0], docs[0], ...
+            name, bracket, index = key.partition('[')
+            if bracket:
+                _meta.setdefault(name, {})[index[:-1]] = val
             else:
                 _meta[key] = val
 
@@ -159,8 +543,122 @@ class SphinxQuery(object):
             _meta.pop('hits')
             _meta.pop('docs')
 
-        _meta['fields'] = {}
-        for k, v in enumerate(self.cursor.description):
-            _meta['fields'][v[0]] = int(k)
+        _meta['fields'] = self._field_positions()
+
+        return _meta
+
+    def _field_positions(self):
+        return dict((column[0], i) for i, column in enumerate(self.description))
+
+
+class _SortKey(object):
+    """Ключ сортировки строки: значения колонок и направление (desc) для каждой"""
+    __slots__ = ('values', 'order')
 
-        self._meta = _meta
+    def __init__(self, values, order):
+        self.values = values
+        self.order = order
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __lt__(self, other):
+        for a, b, desc in zip(self.values, other.values, self.order):
+            if a != b:
+                return a > b if desc else a < b
+        return False
+
+
+class MergedSphinxQuery(SphinxQuery):
+    """
+    Выполняет части запроса (по одному индексу в каждой) параллельно в пуле
+    потоков. Каждый поток получает своё подключение, поэтому части расходятся
+    по разным узлам searchd. Запрос, выполняемый в самом пуле (fetch_async),
+    выполняет части последовательно в своём потоке.
+
+    Строки частей, уже отсортированные в searchd, сливаются по `order`
+    (список пар (колонка, desc); по-умолчанию по весу), затем к ним
+    применяются offset и limit. Документ, найденный в нескольких индексах,
+    берётся из последнего из них, как и в searchd. Метаданные частей
+    суммируются, total_found - приблизительно (см. _merge_meta()).
+    """
+    def __init__(self, parts=None, order=None, offset=0, limit=None, max_matches=None):
+        super(MergedSphinxQuery, self).__init__()
+
+        self._parts = parts or []
+        self._order = order or [('weight', True), ('id', False)]
+        self._offset = offset
+        self._limit = limit
+        self._max_matches = max_matches
+
+    def _get_results(self):
+        if in_worker():
+            # уже в пуле (fetch_async): части выполняются здесь по очереди
+            for part in self._parts:
+                part._get_results()
+        else:
+            pending = [run_async(part._get_results) for part in self._parts]
+            for result in pending:
+                result.get()
+
+        self._merge()
+
+    def _merge(self):
+        """Сливает результаты уже выполненных частей"""
+        first = self._parts[0]
+        self.description = first.description
+
+        fields = first._meta['fields']
+        positions = [fields[name] for name, desc in self._order if name in fields]
+        order = [desc for name, desc in self._order if name in fields]
+
+        # документ из нескольких индексов берётся из последнего (как и в searchd):
+        # в предыдущих индексах его атрибуты могут быть устаревшими
+        id_pos = fields.get('id', 0)
+        seen = set()
+        parts = []
+        dropped = 0
+        for part in reversed(self._parts):
+            rows = list(part._rows)
+            kept = [row for row in rows if row[id_pos] not in seen]
+            seen.update(row[id_pos] for row in kept)
+            dropped += len(rows) - len(kept)
+            parts.append(kept)
+        parts.reverse()
+
+        def decorate(i, rows):
+            for row in rows:
+                yield _SortKey([row[pos] for pos in positions], order), i, row
+
+        merged = heapq.merge(*[decorate(i, rows) for i, rows in enumerate(parts)])
+        end = self._offset + self._limit if self._limit is not None else None
+
+        self._rows = (row for key, i, row in islice(merged, self._offset, end))
+        self._meta = self._merge_meta([part._meta for part in self._parts], dropped)
+
+    def _merge_meta(self, metas, dropped=0):
+        """
+        Суммирует метаданные частей. Документы, найденные в нескольких индексах,
+        вычитаются из total_found, только если они попали в полученные строки,
+        поэтому total_found - оценка сверху (но не меньше, чем в любой из частей).
+
+        :param dropped: сколько повторяющихся документов отброшено при слиянии
+        """
+        meta = dict(metas[0])
+        meta['total'] = sum(int(m.get('total', 0)) for m in metas) - dropped
+        if self._max_matches is not None:
+            meta['total'] = min(meta['total'], self._max_matches)
+        meta['total_found'] = max(sum(int(m.get('total_found', 0)) for m in metas) - dropped,
+                                  max(int(m.get('total_found', 0)) for m in metas))
+        meta['time'] = max(float(m.get('time', 0)) for m in metas)
+
+        words = {}
+        for m in metas:
+            for word, stats in m.get('words', {}).iteritems():
+                w = words.setdefault(word, dict(docs=0, hits=0))
+                w['docs'] += int(stats['docs'])
+                w['hits'] += int(stats['hits'])
+        if words:
+            meta['words'] = words
+
+        return meta
@@ -3,11 +3,12 @@ from __future__ import unicode_literals
 
 __author__ = 'ego'
 
-import MySQLdb
 import re
 import time
 import warnings
 
+from operator import itemgetter
+
 import six
 
 try:
@@ -22,25 +23,34 @@ try:
 except ImportError:
     from django.utils import _decimal as decimal  # for Python 2.3
 
-from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import connections, models
 from django.db.models.fields.related import RelatedField
 from django.db.models.query import QuerySet
 from django.utils.encoding import force_unicode
 
 from djangosphinx.conf import SPHINX_QUERY_OPTS, SPHINX_QUERY_LIMIT, \
     SPHINX_MAX_MATCHES, SPHINX_SNIPPETS, SPHINX_SNIPPETS_OPTS, \
-    DOCUMENT_ID_SHIFT, CONTENT_TYPE_MASK, OBJECT_ID_MASK
+    DOCUMENT_ID_SHIFT, CONTENT_TYPE_MASK, OBJECT_ID_MASK, \
+    SPHINX_SNIPPETS_MIN_BUDGET, SPHINX_FAN_OUT, SPHINX_BREAKER_FALLBACK, \
+    SPHINX_PARALLEL_HYDRATION, SPHINX_OBJECT_CACHE, SPHINX_RESULT_CACHE_TTL, \
+    SPHINX_RESULT_CACHE_STALE_TTL, SPHINX_NEGATIVE_CACHE_TTL
 
 from djangosphinx.constants import EMPTY_RESULT_SET, \
     FILTER_CMP_OPERATIONS, FILTER_CMP_INVERSE
 
+from djangosphinx.query.budget import SearchTimeout, current_deadline, earliest, remaining
+from djangosphinx.query.cache import object_cache, result_cache, negative_cache
 from djangosphinx.query.proxy import SphinxProxy
-from djangosphinx.query.query import SphinxQuery, conn_handler
+from djangosphinx.query.query import SphinxQuery, MergedSphinxQuery, CircuitOpen, conn_handler
+from djangosphinx.query.workers import in_worker, run_async
+from djangosphinx.registry import registry
 from djangosphinx.utils.config import get_sphinx_attr_type_for_field
 from djangosphinx.shortcuts import all_indexes
 
-__all__ = ['SearchError', 'SphinxQuerySet', 'to_sphinx']
+__all__ = ['SearchError', 'SearchTimeout', 'SphinxQuerySet', 'to_sphinx']
+
+# методы QuerySet, которые можно применить к запросу объектов результатов
+HYDRATION_OPTIONS = ('select_related', 'prefetch_related', 'only', 'defer')
 
 
 def to_sphinx(value):
@@ -59,6 +69,8 @@ class SearchError(Exception):
 class SphinxQuerySet(object):
 
     __index_match = re.compile(r'[^a-z0-9_-]*', re.I)
+    __max_query_time = re.compile(r'max_query_time=(\d+)')
+    __order_by = re.compile(r'`@?([^`]+)` (ASC|DESC)')
 
     def __init__(self, model=None, using=None, **kwargs):
         self.model = model
@@ -67,6 +79,10 @@ class SphinxQuerySet(object):
         self._doc_ids = None
 
         self._iter = None
+        self._search = None  # SphinxQuery последнего выполнения, для метаданных
+        self._values = None  # (dict или tuple, атрибуты, flat) для values()/values_list()
+        self._hydration = {}  # модель (None - все модели) -> параметры hydrate()
+        self._pending = None
 
         self._query = None
         self._query_args = None
@@ -101,6 +117,14 @@ class SphinxQuerySet(object):
         self._snippets_opts = kwargs.pop('snippets_options', SPHINX_SNIPPETS_OPTS)
         self._snippets_string = None
 
+        self._fan_out = kwargs.pop('fan_out', SPHINX_FAN_OUT)
+        self._parallel_hydration = kwargs.pop('parallel_hydration', SPHINX_PARALLEL_HYDRATION)
+        self._cache_ttl = SPHINX_RESULT_CACHE_TTL
+        self._cache_stale_ttl = SPHINX_RESULT_CACHE_STALE_TTL
+        self._timeout = kwargs.pop('timeout', None)
+        self._deadline = None  # бюджет, унаследованный от другого потока
+        self._expires = None  # момент истечения времени текущего запроса
+
         if model:
             #self._indexes = self._parse_indexes(kwargs.pop('index', model._meta.db_table))
             self._indexes = [model._meta.db_table]
@@ -112,14 +136,17 @@ class SphinxQuerySet(object):
             self._indexes = self._parse_indexes(kwargs.pop('index', None))
 
     def __len__(self):
+        # количество найденных документов, как и count(). list(qs) спрашивает
+        # длину до первого документа - тогда SHOW META уходит вместе с запросом
+        if self._result_cache is None and self._metadata is None:
+            self._get_results(meta=True)
+
         return self.count()
 
     def __iter__(self):
         if self._result_cache is None:
-            try:
-                self._get_data()
-            except MySQLdb.ProgrammingError as e:
-                raise SearchError(e.args)
+            # запрос выполняется при получении первого документа
+            return self._iter_results()
 
         return iter(self._result_cache)
 
@@ -143,14 +170,17 @@ class SphinxQuerySet(object):
             stop = int(k.stop) if k.stop is not None else None
 
             qs._set_limits(start, stop)
-            qs._get_data()
+            # запрос выполнится при обращении к результатам - вместе с
+            # SHOW META, если сразу понадобится len()
             return k.step and list(qs)[::k.step] or qs
 
         try:
             qs = self._clone()
             qs._set_limits(k, k + 1)
             qs._get_data()
-            return list(qs)[0]
+            return qs._result_cache[0]
+        except SearchTimeout:
+            raise
         except Exception as e:
             raise IndexError(e.args)
 
@@ -221,6 +251,22 @@ class SphinxQuerySet(object):
 
         return self._clone(_snippets_opts=kwargs, _snippets=snippets, _snippets_opts_string=None)
 
+    def timeout(self, seconds):
+        """
+        Ограничивает время выполнения запроса, включая получение объектов
+        из БД и сниппеты. По истечении выбрасывается SearchTimeout.
+        """
+        return self._clone(_timeout=seconds)
+
+    def fan_out(self, enabled=True):
+        """
+        Выполняет запрос по нескольким индексам параллельно: отдельным
+        запросом для каждого индекса, на разных узлах searchd.
+        Результаты сливаются по порядку сортировки (по-умолчанию по весу).
+        Не применяется к выборкам с group_by.
+        """
+        return self._clone(_fan_out=enabled)
+
     # Currently only supports grouping by a single column.
     # The column however can be a computed expression
     def group_by(self, field):
@@ -259,13 +305,298 @@ class SphinxQuerySet(object):
         return self
 
     def count(self):
+        if self._metadata is None and self._search is None and self._pending is None:
+            # результаты не нужны: достаточно одного документа и SHOW META
+            self._metadata = self._get_stats()
+
         return min(int(self.meta.get('total_found', 0)), self._maxmatches)
 
+    def exists(self):
+        """
+        Есть ли в выборке хотя бы один документ. Если результаты ещё не
+        получены, запрашивает один документ без SHOW META и без обращения к БД.
+        """
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        if self._metadata is not None:
+            return int(self._metadata.get('total_found', 0)) > 0
+        if self._pending is not None:
+            return bool(list(self))
+
+        self._prepare_query()
+        query, args = self._get_first_query()
+        empty_key = self._get_empty_key()
+        if empty_key in negative_cache:
+            return False
+        try:
+            found = bool(SphinxQuery(query, args, self._expires, meta_query=(query, args)).fetchmany(1))
+            self._check_empty({'total_found': int(found)}, self._get_add_key(empty_key))
+            return found
+        except CircuitOpen:
+            if SPHINX_BREAKER_FALLBACK != 'empty':
+                raise
+            return False
+        except conn_handler.backend.ProgrammingError as e:
+            raise SearchError(e.args)
+
     # Возвращяет все объекты из индекса. Размер списка ограничен только
     # значением maxmatches
     def all(self):
         return self._clone(_limit=self._maxmatches, _offset=None)
 
+    def hydrate(self, model=None, **options):
+        """
+        Настраивает запрос к БД, которым получаются объекты результатов::
+
+            qs.hydrate(select_related=['author'], only=['title', 'author__name'])
+            qs.hydrate(Comment, prefetch_related='tags')
+
+        :param model: модель, к которой применяются параметры; по-умолчанию - все
+        :param select_related: поля для QuerySet.select_related() или True
+        :param prefetch_related: поля для QuerySet.prefetch_related()
+        :param only: поля для QuerySet.only()
+        :param defer: поля для QuerySet.defer()
+
+        Параметры по-умолчанию для модели задаются в ``__sphinx_options__['hydrate']``.
+        """
+        unknown = set(options) - set(HYDRATION_OPTIONS)
+        if unknown:
+            raise TypeError('Unknown hydration options: %s' % ', '.join(unknown))
+
+        hydration = self._hydration.copy()
+        hydration[model] = dict(hydration.get(model, {}), **options)
+        return self._clone(_hydration=hydration)
+
+    def cache(self, ttl, stale_ttl=None):
+        """
+        Кэширует результаты поиска (ID документов, атрибуты и метаданные)
+        на `ttl` секунд; объекты из БД получаются заново при каждом обращении.
+        ``cache(None)`` отключает кэширование, см. SPHINX_RESULT_CACHE_TTL.
+
+        С `stale_ttl` устаревший результат отдаётся сразу, пока с момента его
+        получения не прошло `stale_ttl` секунд, а запрос повторяется в фоне::
+
+            qs.cache(ttl=30, stale_ttl=300)
+        """
+        assert not stale_ttl or stale_ttl >= ttl, 'stale_ttl must not be less than ttl'
+        return self._clone(_cache_ttl=ttl, _cache_stale_ttl=stale_ttl)
+
+    def parallel_hydration(self, enabled=True):
+        """
+        Запрашивает объекты разных моделей из БД параллельно, в пуле потоков.
+        Запросы идут через отдельные подключения к БД, поэтому не видят
+        незафиксированных изменений текущей транзакции.
+        """
+        return self._clone(_parallel_hydration=enabled)
+
+    def values(self, *attrs):
+        """
+        Результаты в виде словарей {атрибут: значение} прямо из строк Sphinx,
+        без обращения к БД. Без аргументов возвращаются все атрибуты.
+
+        Атрибут ``id`` (или ``pk``) содержит ID объекта, а ``content_type`` -
+        ID его ContentType, декодированные из ID документа.
+        """
+        return self._clone(_values=(dict, attrs, False))
+
+    def values_list(self, *attrs, **kwargs):
+        """
+        То же, что values(), но в виде кортежей. С flat=True и одним
+        атрибутом возвращает сами значения.
+        """
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to values_list: %s' % ', '.join(kwargs))
+        if flat and len(attrs) != 1:
+            raise TypeError('`flat` is only valid when values_list is called with a single attribute')
+
+        return self._clone(_values=(tuple, attrs, flat))
+
+    def ids(self):
+        """Пары (ID объекта, ID ContentType) найденных документов, без обращения к БД"""
+        # выражения fields() остаются в запросе: по ним могут сортировать или фильтровать
+        return self._clone(_fields='`id`', _values=(tuple, ('id', 'content_type'), False))
+
+    def fetch_async(self):
+        """
+        Запускает выполнение запроса в фоновом потоке и сразу возвращает
+        копию выборки. Обращение к результатам копии (итерация, meta, count)
+        дожидается окончания запроса. Позволяет выполнять несколько
+        независимых поисковых запросов одновременно::
+
+            results = qs.fetch_async()
+            related = qs2.fetch_async()
+            ...
+            list(results), list(related)
+        """
+        worker = self._clone()
+        worker._deadline = earliest(self._deadline, current_deadline())
+
+        c = self._clone()
+        c._pending = run_async(worker._fetch)
+        return c
+
+    @classmethod
+    def batch(cls, *querysets):
+        """
+        Выполняет несколько независимых выборок одним пакетом (multi-query)
+        и возвращает их копии с уже полученными результатами::
+
+            results, related, counts = SphinxQuerySet.batch(qs, qs2, qs3)
+
+        Объекты всех выборок получаются из БД одним запросом на модель.
+        Части выборок с fan_out() выполняются в том же пакете.
+        """
+        querysets = [qs._clone() for qs in querysets]
+        batched, queries = [], []
+        for qs in querysets:
+            if qs._pending is None and not isinstance(qs, EmptySphinxQuerySet):
+                qs._iter = qs._search = qs._get_query(meta=True)
+                batched.append(qs)
+                if isinstance(qs._iter, MergedSphinxQuery):
+                    queries.extend(qs._iter._parts)
+                else:
+                    queries.append(qs._iter)
+            else:
+                qs._get_data()
+
+        if batched:
+            try:
+                SphinxQuery.fetch_many(queries)
+            except conn_handler.backend.ProgrammingError as e:
+                raise SearchError(e.args)
+            except CircuitOpen:
+                if SPHINX_BREAKER_FALLBACK != 'empty':
+                    raise
+                for qs in batched:
+                    qs._set_empty()
+                return querysets
+
+            collected = []
+            for qs in batched:
+                if isinstance(qs._iter, MergedSphinxQuery):
+                    qs._iter._merge()
+                qs._metadata = qs._iter.meta
+                if qs._values is not None:
+                    qs._result_cache, qs._iter = qs._build_values(qs._iter), None
+                else:
+                    collected.append((qs, qs._collect_docs()))
+
+            cls._hydrate([(qs, results) for qs, (docs, results) in collected if docs])
+
+            for qs, (docs, results) in collected:
+                qs._result_cache = qs._build_results(docs)
+
+        return querysets
+
+    def facets(self, *fields, **ranges):
+        """
+        Считает количество документов выборки по значениям атрибутов::
+
+            qs.facets('category', 'brand', price=[100, 500])
+
+        Группировки выполняются в searchd одним пакетом с общим MATCH и фильтрами,
+        объекты из БД не запрашиваются.
+
+        :param fields: атрибуты, по значениям которых считаются документы
+        :param ranges: атрибуты и границы диапазонов (по возрастанию)
+        :returns: {атрибут: OrderedDict(значение: количество)}, для диапазонов
+                  ключами служат пары (от, до), None - без ограничения
+        """
+        queries = []
+        for field in fields:
+            queries.append((field, None, self._clone(_group_by='GROUP BY `%s`' % field)))
+
+        for field, bounds in ranges.iteritems():
+            bounds = sorted(bounds)
+            interval = 'INTERVAL(`%s`, %s)' % (field, ', '.join(str(to_sphinx(b)) for b in bounds))
+            qs = self._clone(_aliases={'facet': '%s AS `facet`' % interval}, _group_by='GROUP BY `facet`')
+            queries.append((field, bounds, qs))
+
+        for field, bounds, qs in queries:
+            qs._fields = '*'
+            qs._order_by = 'ORDER BY @count DESC'
+            qs._group_order_by = ''
+            qs._limit = qs._maxmatches
+            qs._offset = 0
+            qs._iter = qs._get_query()
+
+        try:
+            SphinxQuery.fetch_many([qs._iter for field, bounds, qs in queries])
+        except conn_handler.backend.ProgrammingError as e:
+            raise SearchError(e.args)
+        except CircuitOpen:
+            if SPHINX_BREAKER_FALLBACK != 'empty':
+                raise
+            return dict((field, OrderedDict()) for field, bounds, qs in queries)
+
+        facets = {}
+        for field, bounds, qs in queries:
+            columns = qs._iter.fields
+            value_pos = columns['facet' if bounds is not None else field]
+            count_pos = columns['@count']
+
+            counts = OrderedDict()
+            if bounds is not None:
+                # INTERVAL() возвращает номер диапазона
+                edges = [None] + bounds + [None]
+                for i in range(0, len(edges) - 1):
+                    counts[(edges[i], edges[i + 1])] = 0
+
+            for row in qs._iter:
+                if bounds is not None:
+                    edge = int(row[value_pos])
+                    counts[(edges[edge], edges[edge + 1])] = int(row[count_pos])
+                else:
+                    counts[row[value_pos]] = int(row[count_pos])
+
+            facets[field] = counts
+
+        return facets
+
+    def iterator(self, chunk_size=100):
+        """
+        Перебирает результаты, получая объекты из БД порциями по `chunk_size`
+        документов (один запрос на модель для каждой порции), в порядке Sphinx.
+        Результаты не сохраняются в кэше выборки, поэтому память не растёт
+        с количеством документов::
+
+            for obj in Search.search.query('test').all().iterator(500):
+                ...
+        """
+        assert chunk_size > 0, 'Chunk size must be positive'
+
+        if self._result_cache is not None:
+            for result in self._result_cache:
+                yield result
+            return
+
+        qs = self._clone()
+        qs._iter = qs._search = qs._get_query()
+        try:
+            qs._iter.fields
+        except CircuitOpen:
+            if SPHINX_BREAKER_FALLBACK != 'empty':
+                raise
+            return
+        except conn_handler.backend.ProgrammingError as e:
+            raise SearchError(e.args)
+
+        rows, qs._iter = qs._iter, None
+        if qs._values is not None:
+            for value in qs._build_values(rows, lazy=True):
+                yield value
+            return
+
+        while True:
+            docs, results = qs._collect_docs(rows.fetchmany(chunk_size))
+            if not docs:
+                break
+
+            qs._hydrate([(qs, results)])
+            for result in qs._build_results(docs):
+                yield result
+
     def none(self):
         qs = EmptySphinxQuerySet()
         qs.__dict__.update(self.__dict__.copy())
@@ -345,8 +676,9 @@ class SphinxQuerySet(object):
 
         query.append(', '.join(q))
 
-        cursor = conn_handler.cursor()
-        count = cursor.execute(' '.join(query), query_args)
+        count = conn_handler.execute_write(' '.join(query), query_args)
+
+        result_cache.bump(self.realtime)
 
         return count
 
@@ -372,8 +704,9 @@ class SphinxQuerySet(object):
 
         query = ' '.join(q)
 
-        cursor = conn_handler.cursor()
-        cursor.execute(query, self._query_args)
+        conn_handler.execute_write(query, self._query_args)
+
+        result_cache.bump(self.realtime)
 
     # misc
     def keywords(self, text, index=None, hits=None):
@@ -392,11 +725,13 @@ class SphinxQuerySet(object):
 
         query = query % ', '.join(q)
 
-        cursor = conn_handler.cursor()
-        count = cursor.execute(query, [text, index])
+        try:
+            rows = conn_handler.execute(query, [text, index]).fetchall()
+        finally:
+            conn_handler.release()
 
-        for x in range(0, count):
-            yield cursor.fetchone()
+        for row in rows:
+            yield row
 
     def get_query_set(self, model):
         qs = model._default_manager
@@ -408,7 +743,11 @@ class SphinxQuerySet(object):
 
     def _meta(self):
         if self._metadata is None:
-            self._get_data()
+            if self._search is None:
+                # метаданные нужны сразу: SHOW META уйдёт вместе с запросом
+                self._get_data(meta=True)
+            if self._metadata is None:
+                self._metadata = self._search.meta
 
         return self._metadata
 
@@ -449,15 +788,193 @@ class SphinxQuerySet(object):
 
         return self._offset is None
 
-    def _get_data(self):
+    def _fetch(self):
+        try:
+            self._get_data()
+        finally:
+            # поток пула не обрабатывает запросы: Django сам не закроет его подключения к БД
+            for connection in connections.all():
+                connection.close()
+        return self
+
+    def _get_results(self, meta=False):
+        if self._result_cache is None:
+            try:
+                self._get_data(meta)
+            except conn_handler.backend.ProgrammingError as e:
+                raise SearchError(e.args)
+
+    def _iter_results(self):
+        self._get_results()
+        for obj in self._result_cache:
+            yield obj
+
+    def _get_data(self, meta=False):
+        if self._pending is not None:
+            # результаты уже получены (или получаются) в фоновом потоке
+            pending, self._pending = self._pending, None
+            done = pending.get()
+            self._result_cache = done._result_cache
+            self._metadata = done._metadata
+            self._search = done._search
+            return
+
+        # результат для кэша не ограничивается бюджетом времени: иначе неполный
+        # ответ searchd попал бы в кэш для всех последующих запросов
+        self._iter = self._search = self._get_query(meta, capped=not self._cache_ttl)
+        self._result_cache = []
+
+        empty_key = self._get_empty_key() if self._limit != 0 else None
+        if empty_key in negative_cache:
+            self._set_empty()
+            return
+
+        try:
+            if self._cache_ttl:
+                self._fetch_cached(meta)
+            else:
+                self._iter.fields
+        except CircuitOpen:
+            if SPHINX_BREAKER_FALLBACK != 'empty':
+                raise
+            self._set_empty()
+            return
+        self._fill_cache()
+
+        # пустая первая страница - в выборке нет ни одного документа
+        empty_key = self._get_add_key(empty_key, capped=not self._cache_ttl)
+        if not self._result_cache and not self._offset and empty_key is not None:
+            negative_cache.add(empty_key)
+
+    def _fetch_cached(self, meta=False):
+        """Подставляет в запрос результаты из кэша или выполняет его и кэширует результаты"""
+        query = self._build_query(capped=False)
+        key = result_cache.make_key(query, self._query_args, self._indexes)
+        refresh = None
+        if self._cache_stale_ttl:
+            # фоновое обновление выполняется копией: эта выборка принадлежит другому
+            # потоку, и её бюджет времени к обновлению не относится
+            clone = self._clone(_deadline=None, _timeout=None, _expires=None)
+            refresh = lambda: clone._get_query(meta, capped=False).snapshot()
+
+        snapshot = result_cache.fetch(key, self._iter.snapshot, self._cache_ttl, self._expires,
+                                      stale_ttl=self._cache_stale_ttl, refresh=refresh)
+        self._iter.restore(snapshot)
+        if meta and snapshot[2] is None:
+            # документы есть в кэше, метаданные - отдельно
+            self._metadata = self._get_stats()
+
+    def _set_empty(self):
+        # searchd недоступен или запрос уже возвращал пустой результат
+        self._iter = None
+        self._result_cache = []
+        self._metadata = EMPTY_RESULT_SET
+
+    def _get_query(self, meta=False, capped=True):
+        """
+        :param meta: получить метаданные вместе с результатами; иначе
+                     они запрашиваются отдельно при обращении к meta
+        :param capped: см. _build_options()
+        """
+        self._prepare_query()
+
+        if self._fan_out and len(self._indexes) > 1 and not self._group_by:
+            return self._get_merged_query(capped)
+        query = self._build_query(capped)
+        if meta:
+            return SphinxQuery(query, self._query_args, self._expires)
+
+        return SphinxQuery(query, self._query_args, self._expires, self._get_first_query(capped))
+
+    def _prepare_query(self):
         if not self._indexes:
             #warnings.warn('Index list is not set. Using all known indices.')
             self._indexes = self._parse_indexes(all_indexes())
 
-        self._iter = SphinxQuery(self.query_string, self._query_args)
-        self._result_cache = []
-        self._metadata = self._iter.meta
-        self._fill_cache()
+        self._expires = self._get_deadline()
+
+    def _get_first_query(self, capped=True):
+        """
+        Запрос первого документа выборки: (запрос, аргументы).
+        Используется для метаданных - total_found от LIMIT не зависит.
+
+        :param capped: см. _build_options()
+        """
+        first = self._clone(_offset=0, _limit=1)
+        first._expires = self._expires
+        query = first._build_query(capped)
+        return query, first._query_args
+
+    def _get_merged_query(self, capped=True):
+        offset = self._offset or 0
+        limit = self._limit if self._limit is not None else self._maxmatches
+
+        # каждый индекс должен вернуть все документы до конца страницы и ещё
+        # страницу про запас: документы, найденные и в следующих индексах,
+        # при слиянии отбрасываются
+        parts = []
+        for index in self._indexes:
+            part = self._clone(_indexes=[index], _offset=0, _limit=min(offset + 2 * limit, self._maxmatches))
+            part._expires = self._expires
+            parts.append(SphinxQuery(part._build_query(capped), part._query_args, self._expires))
+
+        order = [(field, direction == 'DESC') for field, direction in self.__order_by.findall(self._order_by)]
+        return MergedSphinxQuery(parts, order, offset, limit, self._maxmatches)
+
+    def _get_stats(self):
+        self._prepare_query()
+        query, args = self._get_first_query()
+        empty_key = self._get_empty_key()
+        if empty_key in negative_cache:
+            return EMPTY_RESULT_SET
+        try:
+            if not self._cache_ttl:
+                return self._check_empty(SphinxQuery(query, args, self._expires).metadata(),
+                                         self._get_add_key(empty_key))
+
+            key_query, key_args = self._get_first_query(capped=False)
+            key = result_cache.make_key(key_query, key_args, self._indexes, kind='meta')
+            meta = result_cache.fetch(key, SphinxQuery(key_query, key_args, self._expires).metadata,
+                                      self._cache_ttl, self._expires,
+                                      stale_ttl=self._cache_stale_ttl,
+                                      refresh=lambda: SphinxQuery(key_query, key_args).metadata())
+            return self._check_empty(meta.copy(), empty_key)
+        except CircuitOpen:
+            if SPHINX_BREAKER_FALLBACK != 'empty':
+                raise
+            return EMPTY_RESULT_SET
+        except conn_handler.backend.ProgrammingError as e:
+            raise SearchError(e.args)
+
+    def _get_empty_key(self):
+        """
+        Ключ запроса первого документа в negative_cache (без max_query_time из
+        бюджета времени, как и в result_cache) или None, если он отключён
+        """
+        if not SPHINX_NEGATIVE_CACHE_TTL:
+            return None
+        query, args = self._get_first_query(capped=False)
+        return negative_cache.make_key(query, args, self._indexes)
+
+    def _get_add_key(self, empty_key, capped=True):
+        """
+        Ключ для добавления в negative_cache или None: пустой ответ на запрос,
+        урезанный бюджетом времени, не значит, что документов нет
+        """
+        if capped and self._expires is not None:
+            return None
+        return empty_key
+
+    @staticmethod
+    def _check_empty(meta, empty_key):
+        if empty_key is not None and not int(meta.get('total_found', 0)):
+            negative_cache.add(empty_key)
+        return meta
+
+    def _get_deadline(self):
+        timeout = self._timeout
+        return earliest(self._deadline, current_deadline(),
+                        time.time() + timeout if timeout is not None else None)
 
     ## Options
     def _parse_indexes(self, index):
@@ -489,60 +1006,187 @@ class SphinxQuerySet(object):
     ## Cache
 
     def _fill_cache(self, num=None):
-        fields = self.meta['fields'].copy()
+        if self._values is not None:
+            self._result_cache, self._iter = self._build_values(self._iter or ()), None
+            return
+
+        docs, results = self._collect_docs()
+        if docs:
+            self._hydrate([(self, results)])
+            self._result_cache = self._build_results(docs)
+
+    def _build_values(self, rows, lazy=False):
+        """
+        Результаты values()/values_list() из строк Sphinx
+
+        :param lazy: вернуть генератор вместо списка
+        """
+        kind, attrs, flat = self._values
+        fields = self._search.fields
+        id_pos = fields['id']
+        decode = self._decode_document_id
+
+        if not attrs:
+            attrs = sorted(fields, key=fields.get) + ['content_type']
+
+        getters = []
+        for attr in attrs:
+            if attr in ('id', 'pk'):
+                getters.append(lambda row: decode(int(row[id_pos]))[0])
+            elif attr == 'content_type':
+                getters.append(lambda row: decode(int(row[id_pos]))[1])
+            elif attr in fields:
+                getters.append(itemgetter(fields[attr]))
+            else:
+                raise SearchError('Unknown attribute `%s`' % attr)
+
+        if flat:
+            values = (getters[0](row) for row in rows)
+        elif kind is dict:
+            values = (dict((attr, get(row)) for attr, get in zip(attrs, getters)) for row in rows)
+        else:
+            values = (tuple(get(row) for get in getters) for row in rows)
+
+        return values if lazy else list(values)
+
+    def _collect_docs(self, rows=None):
+        """
+        Читает документы из результатов запроса (или из переданных строк `rows`).
+
+        :returns: tuple(документы по порядку, {ContentTypeID: {ObjectID: {}}}),
+                  словари второго элемента получают объекты при _hydrate()
+        """
+        fields = self._search.fields.copy()
         id_pos = fields.pop('id')
         ct = None
         results = {}
 
         docs = OrderedDict()
 
-        if self._iter:
-            try:
-                while True:
-                    doc = self._iter.next()
-                    doc_id = doc[id_pos]
+        if rows is None:
+            rows, self._iter = self._iter or (), None
 
-                    obj_id, ct = self._decode_document_id(int(doc_id))
+        fields = fields.items()
+        decode = self._decode_document_id
 
-                    results.setdefault(ct, {})[obj_id] = {}
+        for doc in rows:
+            doc_id = doc[id_pos]
 
-                    docs.setdefault(doc_id, {})['results'] = results[ct][obj_id]
-                    docs[doc_id]['data'] = {}
+            obj_id, ct = decode(int(doc_id))
 
-                    for field in fields:
-                        docs[doc_id]['data'].setdefault('fields', {})[field] = doc[fields[field]]
-            except StopIteration:
-                self._iter = None
-                if not docs:
-                    self._result_cache = []
-                    return
+            result = results.setdefault(ct, {})[obj_id] = {}
 
-                if self.model is None and len(self._indexes) == 1 and ct is not None:
-                    self.model = ContentType.objects.get(pk=ct).model_class()
+            data = {}
+            if fields:
+                data['fields'] = dict((field, doc[pos]) for field, pos in fields)
 
-                if self.model:
-                    qs = self.get_query_set(self.model)
+            docs[doc_id] = dict(results=result, data=data)
 
-                    qs = qs.filter(pk__in=results[ct].keys())
+        if docs and self.model is None and len(self._indexes) == 1 and ct is not None:
+            self.model = registry.get_model(ct)
 
-                    for obj in qs:
-                        results[ct][obj.pk]['obj'] = obj
+        return docs, results
 
-                else:
-                    for ct in results:
-                        model_class = ContentType.objects.get(pk=ct).model_class()
-                        qs = self.get_query_set(model_class).filter(pk__in=results[ct].keys())
+    @staticmethod
+    def _hydrate(collected):
+        """
+        Получает из БД объекты для документов нескольких выборок,
+        по одному запросу на модель (с parallel_hydration() - одновременно)
 
-                        for obj in qs:
-                            results[ct][obj.pk]['obj'] = obj
+        :param collected: список пар (выборка, результаты _collect_docs())
+        """
+        # (модель, БД, параметры hydrate()) -> (выборка, {ObjectID: [результаты]})
+        lookups = OrderedDict()
+
+        for qs, results in collected:
+            remaining(qs._expires)
+            hydration = repr(sorted(qs._hydration.items()))
+
+            for ct, objects in results.iteritems():
+                model = qs.model or registry.get_model(ct)
+                _, pks = lookups.setdefault((model, qs.using, hydration), (qs, {}))
+                for obj_id, result in objects.iteritems():
+                    pks.setdefault(obj_id, []).append(result)
+
+        # результаты заполняются по ссылке, поэтому порядок документов Sphinx
+        # сохраняется независимо от порядка выполнения запросов. В пуле
+        # (fetch_async) запросы выполняются здесь же: задача пула не ждёт других,
+        # а подключения к БД закрываются по её окончании (см. _fetch())
+        parallel = len(lookups) > 1 and not in_worker()
+        fetched, pending = [], []
+        for (model, _, _), (qs, pks) in lookups.iteritems():
+            if parallel and qs._parallel_hydration:
+                pending.append((run_async(qs._get_objects, model, pks.keys(), close=True), pks))
+            else:
+                fetched.append((qs._get_objects(model, pks.keys()), pks))
+        fetched.extend((result.get(), pks) for result, pks in pending)
 
-                if self._snippets:
-                    for doc in docs.values():
-                        doc['data']['snippets'] = self._get_snippets(doc['results']['obj'])
-                        self._result_cache.append(SphinxProxy(doc['results']['obj'], doc['data']))
-                else:
-                    for doc in docs.values():
-                        self._result_cache.append(SphinxProxy(doc['results']['obj'], doc['data']))
+        for objects, pks in fetched:
+            for obj_id, obj in objects.iteritems():
+                for result in pks[obj_id]:
+                    result['obj'] = obj
+
+    def _get_objects(self, model, pks, close=False):
+        """
+        Объекты модели по ID, {ID: объект}. С close=True закрывает затем
+        подключение к БД: в фоновых потоках Django сам его не закроет.
+        """
+        # в кэше лежат объекты, полученные с параметрами hydrate() модели
+        cached = getattr(model, '__sphinx_options__', {}).get('object_cache', SPHINX_OBJECT_CACHE) \
+            and not self._hydration.get(None) and not self._hydration.get(model)
+
+        qs = self._get_hydration_query_set(model)
+        objects = {}
+        if cached:
+            objects = object_cache.get_many(model, pks, qs.db)
+            pks = [pk for pk in pks if pk not in objects]
+            if not pks:
+                return objects
+
+        try:
+            fetched = qs.in_bulk(pks)
+        finally:
+            if close:
+                connections[qs.db].close()
+
+        if cached:
+            object_cache.set_many(model, fetched, qs.db)
+        objects.update(fetched)
+        return objects
+
+    def _get_hydration_query_set(self, model):
+        """QuerySet для получения объектов модели с параметрами hydrate()"""
+        options = dict(getattr(model, '__sphinx_options__', {}).get('hydrate', {}))
+        options.update(self._hydration.get(None, {}))
+        options.update(self._hydration.get(model, {}))
+
+        qs = self.get_query_set(model)
+        for option in HYDRATION_OPTIONS:
+            fields = options.get(option)
+            if not fields:
+                continue
+            if fields is True:
+                fields = ()
+            elif isinstance(fields, six.string_types):
+                fields = (fields,)
+            qs = getattr(qs, option)(*fields)
+
+        return qs
+
+    def _build_results(self, docs):
+        proxies = []
+        snippets = self._snippets
+        for doc in docs.values():
+            if snippets:
+                # сниппеты не обязательны: пропускаем их, если время на исходе
+                try:
+                    if self._expires is not None and remaining(self._expires) < SPHINX_SNIPPETS_MIN_BUDGET:
+                        raise SearchTimeout
+                    doc['data']['snippets'] = self._get_snippets(doc['results']['obj'])
+                except SearchTimeout:
+                    snippets = False
+            proxies.append(SphinxProxy(doc['results']['obj'], doc['data']))
+        return proxies
 
 
     ## Snippets
@@ -557,12 +1201,14 @@ class SphinxQuerySet(object):
             opts)
         docs += (self._query or '',)
 
-        c = conn_handler.cursor()
-        c.execute(query, docs)
+        try:
+            rows = conn_handler.execute(query, docs, self._expires).fetchall()
+        finally:
+            conn_handler.release()
 
         snippets = {}
-        for field in fields:
-            snippets[field] = c.fetchone()[0].decode('utf-8')
+        for field, row in zip(fields, rows):
+            snippets[field] = row[0].decode('utf-8')
 
         return snippets
 
@@ -602,6 +1248,11 @@ class SphinxQuerySet(object):
 
     def _get_index_fields(self):
         if self._index_fields_cache is None:
+            schema = registry.get_schema(self.model)
+            if schema is not None:
+                self._index_fields_cache = schema.fields
+                return schema.fields
+
             opts = self.model.__sphinx_options__
 
             excluded = opts.get('excluded_fields', [])
@@ -638,9 +1289,7 @@ class SphinxQuerySet(object):
 
     def _encode_document_id(self, id):
         if self.model:
-            ct = ContentType.objects.get_for_model(self.model)
-
-            id = int(ct.id) << DOCUMENT_ID_SHIFT | id
+            id = registry.get_content_type_id(self.model) << DOCUMENT_ID_SHIFT | id
 
         return id
 
@@ -738,7 +1387,7 @@ class SphinxQuerySet(object):
 
 
     ## Query
-    def _build_query(self):
+    def _build_query(self, capped=True):
         self._query_args = []
 
         q = ['SELECT']
@@ -756,12 +1405,32 @@ class SphinxQuerySet(object):
         q.extend(self._build_limits())
 
         if self._query_opts is not None:
-            q.append(self._query_opts)
+            q.append(self._build_options(capped))
 
         return ' '.join(q)
 
     query_string = property(_build_query)
 
+    def _build_options(self, capped=True):
+        """
+        :param capped: ограничить max_query_time оставшимся бюджетом времени;
+                       без ограничения строятся ключи кэша (оставшееся время
+                       меняется от запроса к запросу) и запросы, результаты
+                       которых кэшируются (они не должны быть неполными)
+        """
+        opts = self._query_opts
+        if self._expires is None or not capped:
+            return opts
+
+        # searchd не должен искать дольше, чем осталось времени
+        left = max(int((self._expires - time.time()) * 1000), 1)
+        m = self.__max_query_time.search(opts)
+        if m is None:
+            return '%s max_query_time=%i' % ('%s,' % opts if opts else 'OPTION', left)
+        if int(m.group(1)) > left:
+            return opts.replace(m.group(0), 'max_query_time=%i' % left)
+        return opts
+
     def _build_fields(self):
         q = []
         if self._fields:
@@ -823,6 +1492,9 @@ class SphinxQuerySet(object):
         c._result_cache = None
         c._metadata = None
         c._iter = None
+        c._search = None
+        c._pending = None
+        c._expires = None
 
         for k, v in kwargs.iteritems():
             setattr(c, k, v)
@@ -831,7 +1503,13 @@ class SphinxQuerySet(object):
 
 
 class EmptySphinxQuerySet(SphinxQuerySet):
-    def _get_data(self):
+    def _get_data(self, meta=False):
         self._iter = iter([])
         self._result_cache = []
         self._metadata = EMPTY_RESULT_SET
+
+    def _get_stats(self):
+        return EMPTY_RESULT_SET
+
+    def exists(self):
+        return False
@@ -0,0 +1,91 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import os
+
+from multiprocessing.pool import ThreadPool
+from threading import BoundedSemaphore, Lock, local
+
+from djangosphinx.conf import SPHINX_WORKER_THREADS, SPHINX_RESULT_CACHE_REFRESH_THREADS
+
+__all__ = ['get_worker_pool', 'run_async', 'in_worker', 'get_refresh_pool', 'run_refresh']
+
+_worker_pool = None
+_worker_pid = None
+_refresh_pool = None
+_refresh_slots = None
+_refresh_pid = None
+_lock = Lock()
+_local = local()
+
+
+def _init_worker():
+    _local.worker = True
+
+
+def get_worker_pool():
+    """
+    Общий для процесса пул потоков, выполняющих поисковые запросы в фоне.
+    Создаётся заново после fork(), т.к. потоки в дочерний процесс не переходят.
+    """
+    global _worker_pool, _worker_pid
+    with _lock:
+        if _worker_pool is None or _worker_pid != os.getpid():
+            _worker_pool = ThreadPool(SPHINX_WORKER_THREADS, _init_worker)
+            _worker_pid = os.getpid()
+        return _worker_pool
+
+
+def run_async(func, *args, **kwargs):
+    """
+    Выполняет func(*args, **kwargs) в пуле потоков.
+
+    :returns: AsyncResult; результат (или исключение) можно получить через get()
+    """
+    return get_worker_pool().apply_async(func, args, kwargs)
+
+
+def in_worker():
+    """
+    Выполняется ли текущий поток в пуле. Задача пула не должна ждать
+    другие задачи того же пула: когда все потоки заняты такими задачами,
+    ждать результата некому.
+    """
+    return getattr(_local, 'worker', False)
+
+
+def get_refresh_pool():
+    """
+    Отдельный пул для фоновых обновлений кэша результатов, чтобы они не
+    занимали потоки SPHINX_WORKER_THREADS и не стояли в их очереди.
+
+    :returns: (пул, семафор свободных потоков пула)
+    """
+    global _refresh_pool, _refresh_slots, _refresh_pid
+    with _lock:
+        if _refresh_pool is None or _refresh_pid != os.getpid():
+            _refresh_pool = ThreadPool(SPHINX_RESULT_CACHE_REFRESH_THREADS)
+            _refresh_slots = BoundedSemaphore(SPHINX_RESULT_CACHE_REFRESH_THREADS)
+            _refresh_pid = os.getpid()
+        return _refresh_pool, _refresh_slots
+
+
+def run_refresh(func):
+    """
+    Выполняет func() в пуле фоновых обновлений, если в нём есть свободный
+    поток; иначе func() не выполняется - в очередь обновления не ставятся.
+
+    :returns: True, если func() передана в пул
+    """
+    pool, slots = get_refresh_pool()
+    if not slots.acquire(False):
+        return False
+
+    def run():
+        try:
+            func()
+        finally:
+            slots.release()
+
+    pool.apply_async(run)
+    return True
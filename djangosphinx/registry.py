@@ -0,0 +1,170 @@
+# coding: utf-8
+"""
+Реестр индексов: для каждой модели с SphinxSearch хранит её индексы,
+ID ContentType и схему индекса. Собирается один раз при первом обращении,
+после чего поиск не обращается к БД за метаданными.
+"""
+from __future__ import unicode_literals
+
+import itertools
+
+from collections import OrderedDict
+from threading import RLock
+
+from django.db import models
+from django.db.models.fields import FieldDoesNotExist
+
+__all__ = ['IndexSchema', 'IndexRegistry', 'registry']
+
+
+class IndexSchema(object):
+    """
+    Схема индекса модели
+
+    :param name: название индекса
+    :param model: класс модели
+    :param content_type: ID ContentType модели
+    """
+    def __init__(self, name, model, content_type):
+        from djangosphinx.utils.config import get_sphinx_attr_type_for_field
+
+        self.name = name
+        self.model = model
+        self.content_type = content_type
+
+        opts = model.__sphinx_options__
+        excluded = opts.get('excluded_fields', [])
+
+        # поля в порядке колонок индекса, как при INSERT/REPLACE
+        fields = []
+        for f in ['included_fields', 'stored_attributes',
+                  'stored_fields', 'related_fields', 'mva_fields']:
+            fields.extend(opts.get(f, []))
+        for f in excluded:
+            if f in fields:
+                fields.pop(fields.index(f))
+        fields.insert(0, 'id')
+
+        self.fields = fields
+        self.stored_attributes = [f for f in opts.get('stored_attributes', []) if f not in excluded]
+
+        # тип атрибута Sphinx для каждого поля модели, попавшего в индекс
+        self.attr_types = {}
+        for name in fields[1:]:
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            self.attr_types[name] = get_sphinx_attr_type_for_field(field)
+
+    def __repr__(self):
+        return '<IndexSchema %s: %s.%s>' % (self.name, self.model._meta.app_label,
+                                            self.model._meta.object_name)
+
+
+class IndexRegistry(object):
+    """
+    Отображения индекс -> схема, модель -> ID ContentType и обратно.
+
+    В Django 1.5 нет AppConfig.ready(), поэтому реестр заполняется
+    при первом обращении, когда все модели уже загружены. ContentType
+    моделей, не имеющих индексов, запрашиваются из БД один раз
+    и тоже запоминаются.
+    """
+    def __init__(self):
+        self._lock = RLock()
+        self._populated = False
+        self._indexes = OrderedDict()   # индекс -> IndexSchema
+        self._models = {}               # модель -> [IndexSchema]
+        self._ct_models = {}            # ID ContentType -> модель
+        self._model_cts = {}            # модель -> ID ContentType
+
+    def populate(self):
+        """Собирает реестр, если он ещё не собран"""
+        if self._populated:
+            return
+
+        with self._lock:
+            if self._populated:
+                return
+
+            from django.contrib.contenttypes.models import ContentType
+
+            indexed = []
+            model_classes = itertools.chain(*(models.get_models(app) for app in models.get_apps()))
+            for model in model_classes:
+                if getattr(model._meta, 'proxy', False) or getattr(model._meta, 'abstract', False):
+                    continue
+                if getattr(model, '__sphinx_indexes__', None) is not None:
+                    indexed.append(model)
+
+            # один запрос на все модели
+            content_types = ContentType.objects.get_for_models(*indexed) if indexed else {}
+
+            for model in indexed:
+                ct = content_types[model].id
+                self._remember(model, ct)
+                for index in model.__sphinx_indexes__:
+                    schema = IndexSchema(index, model, ct)
+                    self._indexes[index] = schema
+                    self._models.setdefault(model, []).append(schema)
+
+            self._populated = True
+
+    def clear(self):
+        with self._lock:
+            self._populated = False
+            self._indexes.clear()
+            self._models.clear()
+            self._ct_models.clear()
+            self._model_cts.clear()
+
+    @property
+    def indexes(self):
+        """Названия индексов всех моделей"""
+        self.populate()
+        return list(self._indexes)
+
+    def get_index(self, name):
+        """Схема индекса `name` или None"""
+        self.populate()
+        return self._indexes.get(name)
+
+    def get_schema(self, model):
+        """Схема первого индекса модели или None"""
+        self.populate()
+        schemas = self._models.get(model)
+        return schemas[0] if schemas else None
+
+    def get_model(self, ct):
+        """Класс модели по ID ContentType"""
+        self.populate()
+        try:
+            return self._ct_models[ct]
+        except KeyError:
+            from django.contrib.contenttypes.models import ContentType
+
+            model = ContentType.objects.get_for_id(ct).model_class()
+            with self._lock:
+                self._remember(model, ct)
+            return model
+
+    def get_content_type_id(self, model):
+        """ID ContentType модели"""
+        self.populate()
+        try:
+            return self._model_cts[model]
+        except KeyError:
+            from django.contrib.contenttypes.models import ContentType
+
+            ct = ContentType.objects.get_for_model(model).id
+            with self._lock:
+                self._remember(model, ct)
+            return ct
+
+    def _remember(self, model, ct):
+        self._ct_models.setdefault(ct, model)
+        self._model_cts[model] = ct
+
+
+registry = IndexRegistry()
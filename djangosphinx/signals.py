@@ -0,0 +1,10 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+from django.dispatch import Signal
+
+__all__ = ['breaker_state_changed']
+
+# состояние предохранителя подключений к searchd изменилось;
+# sender - CircuitBreaker, состояния: closed, open, half-open
+breaker_state_changed = Signal(providing_args=['old_state', 'new_state', 'failures'])
@@ -8,17 +8,39 @@ Replace this with more appropriate tests for your application.
 from __future__ import unicode_literals, absolute_import
 
 import datetime
+import socket
+import struct
+import threading
 import time
 
+import MySQLdb
+
+from django.contrib.contenttypes.models import ContentType
 from django.db.models.query import QuerySet
+from django.db.models.signals import post_save
 from django.db.models.fields import FieldDoesNotExist
 from django.test import TestCase
 
 from django_any import any_model
 
 from djangosphinx import models as ds
-from djangosphinx.conf import SPHINX_MAX_MATCHES, SPHINX_QUERY_LIMIT
-from djangosphinx.query.queryset import EmptySphinxQuerySet, EMPTY_RESULT_SET
+from djangosphinx.conf import SPHINX_MAX_MATCHES, SPHINX_QUERY_LIMIT, DOCUMENT_ID_SHIFT
+from djangosphinx.query.queryset import EmptySphinxQuerySet, SearchError, EMPTY_RESULT_SET
+from djangosphinx.query.pool import ConnectionPool, PoolTimeout
+from djangosphinx.query.backends import native
+from djangosphinx.query.balancer import Node, get_balancer
+from djangosphinx.query.budget import SearchTimeout, search_budget, current_deadline
+from djangosphinx.query import query as sphinx_query
+from djangosphinx.query.query import ConnectionHandler, ConnectionError, CircuitOpen, PoolExhausted, SphinxQuery
+from djangosphinx.query.breaker import CircuitBreaker
+from djangosphinx.query import queryset as sphinx_queryset
+from djangosphinx.query import cache as sphinx_cache
+from djangosphinx.query import workers
+from djangosphinx.signals import breaker_state_changed
+from djangosphinx.registry import registry
+from djangosphinx.query.cache import LRUCache, SingleFlight, ResultCache, object_cache, result_cache, \
+    negative_cache, invalidate_object
+from djangosphinx.shortcuts import all_indexes
 
 from .models import *
 
@@ -59,6 +81,1468 @@ class TestEmptyQueryset(TestCase):
         self.assertEqual([], list(qs));
 
 
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(TestCase):
+
+    def test_reuse(self):
+        pool = ConnectionPool(FakeConnection, max_size=2)
+
+        conn = pool.get()
+        pool.put(conn)
+        self.assertIs(conn, pool.get())
+
+        self.assertEqual(1, pool.stats['misses'])
+        self.assertEqual(1, pool.stats['hits'])
+        self.assertEqual(1, pool.size)
+
+    def test_timeout(self):
+        pool = ConnectionPool(FakeConnection, max_size=1, timeout=0.01)
+
+        conn = pool.get()
+        self.assertRaises(PoolTimeout, pool.get)
+        self.assertEqual(1, pool.stats['waits'])
+        self.assertEqual(1, pool.stats['timeouts'])
+
+        pool.discard(conn)
+        self.assertTrue(conn.connection.closed)
+        self.assertIsNot(conn, pool.get())
+
+    def test_expiration(self):
+        pool = ConnectionPool(FakeConnection, max_idle=0)
+
+        conn = pool.get()
+        pool.put(conn)
+        self.assertIsNot(conn, pool.get())
+        self.assertTrue(conn.connection.closed)
+
+        pool = ConnectionPool(FakeConnection, max_lifetime=0)
+
+        conn = pool.get()
+        pool.put(conn)
+        self.assertEqual(0, pool.idle)
+        self.assertEqual(0, pool.size)
+        self.assertEqual(1, pool.stats['evicted'])
+
+    def test_fill(self):
+        pool = ConnectionPool(FakeConnection, max_size=3)
+
+        conn = pool.get()
+        self.assertEqual(1, pool.fill(2))
+        self.assertEqual(1, pool.idle)
+        self.assertEqual(1, pool.fill(5))
+        self.assertEqual(3, pool.size)
+
+        pool.put(conn)
+        self.assertEqual(3, pool.idle)
+        self.assertEqual(1, pool.stats['misses'])
+
+
+class FakeCursor(object):
+    rowcount = 0
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query, args=None):
+        if self.connection.broken:
+            raise MySQLdb.OperationalError(2006, 'MySQL server has gone away')
+        self.connection.queries.append(query)
+
+
+class FakeSearchdConnection(FakeConnection):
+    broken = False
+
+    def __init__(self):
+        super(FakeSearchdConnection, self).__init__()
+        self.queries = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakeConnectionHandler(ConnectionHandler):
+    """Подключается к фейковым searchd; узлы из `down` недоступны"""
+    def __init__(self, nodes, balancer='round_robin', down=()):
+        super(FakeConnectionHandler, self).__init__(nodes, balancer)
+        self.down = set(down)
+
+    def _connect(self, node):
+        if node.port in self.down:
+            raise MySQLdb.OperationalError(2003, 'Can\'t connect to searchd')
+        conn = FakeSearchdConnection()
+        conn.port = node.port
+        return conn
+
+
+class TestConnectionHandler(TestCase):
+
+    def setUp(self):
+        self.handler = FakeConnectionHandler([dict(host='localhost', port=9306)])
+
+    def tearDown(self):
+        self.handler.release()
+
+    def test_replay(self):
+        broken = self.handler.connection
+        broken.broken = True
+
+        self.handler.execute('SELECT * FROM index')
+
+        self.assertTrue(broken.closed)
+        self.assertListEqual(['SELECT * FROM index'], self.handler.connection.queries)
+
+    def test_no_replay(self):
+        for query in ['INSERT INTO index_rt (id) VALUES (1)', 'SHOW META']:
+            self.handler.connection.broken = True
+            self.assertRaises(MySQLdb.OperationalError, self.handler.execute, query)
+            self.assertListEqual([], self.handler.connection.queries)
+
+    def test_failover(self):
+        handler = FakeConnectionHandler([dict(host='localhost', port=port) for port in (1, 2, 3)], down=[1, 2])
+
+        for x in range(0, 3):
+            handler.execute('SELECT * FROM index')
+            self.assertEqual(3, handler.connection.port)
+            handler.release()
+
+        stats = handler.stats()
+        self.assertFalse(stats['localhost:1']['up'])
+        self.assertFalse(stats['localhost:2']['up'])
+        self.assertTrue(stats['localhost:3']['up'])
+
+        handler.down = set([1, 2, 3])
+        handler.balancer.nodes[2].pool.clear()
+        self.assertRaises(ConnectionError, handler.execute, 'SELECT * FROM index')
+
+    def _connect_logged(self, handler):
+        connections = []
+        connect = handler._connect
+        handler._connect = lambda node: connections.append(connect(node)) or connections[-1]
+        return connections
+
+    def test_write(self):
+        query = 'DELETE FROM index_rt WHERE id = 1'
+
+        handler = FakeConnectionHandler([dict(host='localhost', port=1), dict(host='localhost', port=2, writer=True)])
+        connections = self._connect_logged(handler)
+        handler.execute_write(query)
+        self.assertEqual([2], [conn.port for conn in connections])
+        self.assertEqual([query], connections[0].queries)
+        self.assertIsNone(handler._held())
+
+        # узлы с writer=True не заданы - запрос выполняется на каждом
+        handler = FakeConnectionHandler([dict(host='localhost', port=port) for port in (1, 2)])
+        connections = self._connect_logged(handler)
+        handler.execute_write(query)
+        self.assertEqual([1, 2], [conn.port for conn in connections])
+        self.assertEqual([[query]] * 2, [conn.queries for conn in connections])
+        self.assertEqual([0, 0], [node.outstanding for node in handler.balancer.nodes])
+
+        handler.down = set([2])
+        handler.balancer.nodes[1].pool.clear()
+        self.assertRaises(MySQLdb.OperationalError, handler.execute_write, query)
+        self.assertIsNone(handler._held())
+
+    def test_warm_up(self):
+        handler = FakeConnectionHandler([dict(host='localhost', port=port) for port in (1, 2)], down=[2])
+
+        self.assertEqual(3, handler.warm_up(3))
+
+        first, second = handler.balancer.nodes
+        self.assertEqual(3, first.pool.idle)
+        self.assertEqual(0, second.pool.idle)
+        self.assertFalse(second.is_up())
+
+
+    def test_deadline(self):
+        self.assertRaises(SearchTimeout, self.handler.execute, 'SELECT * FROM index', deadline=time.time() - 1)
+        self.assertListEqual([], self.handler.connection.queries)
+
+        self.handler.execute('SELECT * FROM index', deadline=time.time() + 10)
+        self.assertListEqual(['SELECT * FROM index'], self.handler.connection.queries)
+
+    def test_deadline_error(self):
+        backend = self.handler.backend
+        timeouts = []
+
+        def execute(cursor, query, args=None):
+            raise backend.ProgrammingError(1064, 'syntax error')
+
+        backend.set_timeout = lambda connection, timeout: timeouts.append(timeout) or True
+        backend.execute = execute
+        self.addCleanup(delattr, backend, 'set_timeout')
+        self.addCleanup(delattr, backend, 'execute')
+
+        # ограничение времени снимается до возврата подключения в пул
+        self.assertRaises(backend.ProgrammingError, self.handler.execute, 'SELEC', deadline=time.time() + 10)
+        self.assertEqual(2, len(timeouts))
+        self.assertEqual(None, timeouts[1])
+
+
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        self.changes = []
+        breaker_state_changed.connect(self._changed)
+
+    def tearDown(self):
+        breaker_state_changed.disconnect(self._changed)
+
+    def _changed(self, sender, old_state, new_state, failures, **kwargs):
+        self.changes.append((old_state, new_state, failures))
+
+    def test_breaker(self):
+        handler = FakeConnectionHandler([dict(host='localhost', port=1)], down=[1])
+        handler.breaker = CircuitBreaker(threshold=2, probe_interval=0.05)
+
+        for x in range(0, 2):
+            self.assertRaises(ConnectionError, handler.execute, 'SELECT * FROM index')
+        self.assertEqual('open', handler.breaker.state)
+
+        handler.down = set()
+        self.assertRaises(CircuitOpen, handler.execute, 'SELECT * FROM index')
+
+        time.sleep(0.05)
+        handler.execute('SELECT * FROM index')
+        handler.release()
+        self.assertEqual('closed', handler.breaker.state)
+
+        self.assertEqual([('closed', 'open', 2), ('open', 'half-open', 2), ('half-open', 'closed', 0)],
+                         self.changes)
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(threshold=1, probe_interval=0)
+        breaker.failure()
+
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())  # пробный запрос уже выполняется
+
+        breaker.failure()
+        self.assertEqual('open', breaker.state)
+
+        # отменённый пробный запрос не замыкает и не размыкает предохранитель
+        self.assertTrue(breaker.allow())
+        breaker.cancel()
+        self.assertEqual('half-open', breaker.state)
+        self.assertTrue(breaker.allow())
+
+    def test_client_side(self):
+        handler = FakeConnectionHandler([dict(host='localhost', port=1)])
+        handler.breaker = CircuitBreaker(threshold=1, probe_interval=10)
+
+        def checkout(node):
+            raise PoolTimeout('No free searchd connection')
+
+        # все подключения пула заняты - searchd тут ни при чём
+        handler._checkout = checkout
+        self.assertRaises(PoolExhausted, handler.execute, 'SELECT * FROM index')
+        self.assertEqual('closed', handler.breaker.state)
+
+        calls = []
+
+        def remaining(deadline):
+            calls.append(deadline)
+            if len(calls) > 1:
+                raise SearchTimeout('Search time budget exceeded')
+            return 10
+
+        # время вышло до отправки запроса
+        remaining_, sphinx_query.remaining = sphinx_query.remaining, remaining
+        self.addCleanup(setattr, sphinx_query, 'remaining', remaining_)
+        self.assertRaises(SearchTimeout, handler.execute, 'SELECT * FROM index', None, time.time() + 10)
+        self.assertEqual('closed', handler.breaker.state)
+
+    def test_fallback(self):
+        qs = ds.SphinxQuerySet(index='index')
+        breaker = sphinx_query.conn_handler.breaker
+        sphinx_query.conn_handler.breaker = CircuitBreaker(threshold=1, probe_interval=10)
+        sphinx_query.conn_handler.breaker.failure()
+        self.addCleanup(setattr, sphinx_query.conn_handler, 'breaker', breaker)
+
+        self.assertRaises(CircuitOpen, list, qs)
+
+        fallback, sphinx_queryset.SPHINX_BREAKER_FALLBACK = sphinx_queryset.SPHINX_BREAKER_FALLBACK, 'empty'
+        self.addCleanup(setattr, sphinx_queryset, 'SPHINX_BREAKER_FALLBACK', fallback)
+
+        self.assertListEqual([], list(qs.all()))
+        self.assertEqual(0, qs.all().count())
+
+
+class TestSearchBudget(TestCase):
+
+    def test_search_budget(self):
+        self.assertEqual(None, current_deadline())
+
+        with search_budget(10):
+            outer = current_deadline()
+            with search_budget(100):
+                self.assertEqual(outer, current_deadline())
+            with search_budget(1):
+                self.assertTrue(current_deadline() < outer)
+            self.assertEqual(outer, current_deadline())
+
+        self.assertEqual(None, current_deadline())
+
+    def test_timeout(self):
+        qs = ds.SphinxQuerySet(index='index', query_options={'max_query_time': 100000})
+
+        qs1 = qs.timeout(0.5)
+        self.assertEqual(0.5, qs1._timeout)
+        self.assertEqual(None, qs._timeout)
+
+        qs1._expires = qs1._get_deadline()
+        self.assertRegexpMatches(qs1._build_options(), r'max_query_time=(500|499)\b')
+
+        qs2 = ds.SphinxQuerySet(index='index', query_options={'max_query_time': 100})
+        with search_budget(10):
+            qs2._expires = qs2._get_deadline()
+            self.assertRegexpMatches(qs2._build_options(), r'max_query_time=100\b')
+
+        qs3 = ds.SphinxQuerySet(index='index', query_options={'ranker': 'none'})
+        with search_budget(10):
+            qs3._expires = qs3._get_deadline()
+            self.assertTrue(qs3._build_options().startswith('OPTION ranker=none, max_query_time='))
+
+
+class TestBalancers(TestCase):
+
+    def _nodes(self, *weights):
+        return [Node('localhost', port, weight) for port, weight in enumerate(weights)]
+
+    def _select(self, balancer, times):
+        ports = []
+        for x in range(0, times):
+            node = balancer.select()
+            ports.append(node.port)
+            balancer.done(node)
+        return ports
+
+    def test_round_robin(self):
+        balancer = get_balancer('round_robin', self._nodes(2, 1))
+
+        self.assertListEqual([0, 1, 0, 0, 1, 0], self._select(balancer, 6))
+
+        balancer.mark_down(balancer.nodes[0])
+        self.assertListEqual([1, 1], self._select(balancer, 2))
+
+    def test_least_outstanding(self):
+        balancer = get_balancer('least_outstanding', self._nodes(1, 1))
+
+        first = balancer.select()
+        second = balancer.select()
+        self.assertNotEqual(first, second)
+
+        balancer.done(first)
+        self.assertEqual(first, balancer.select())
+
+    def test_latency_ewma(self):
+        balancer = get_balancer('latency_ewma', self._nodes(1, 1))
+        slow, fast = balancer.nodes
+
+        balancer.record(slow, 0.5)
+        balancer.record(fast, 0.1)
+        self.assertListEqual([1, 1], self._select(balancer, 2))
+
+        balancer.record(fast, 2.0)
+        self.assertEqual(0.1 + 0.3 * 1.9, fast.latency)
+        self.assertListEqual([0], self._select(balancer, 1))
+
+    def test_all_down(self):
+        balancer = get_balancer('round_robin', self._nodes(1, 1))
+        first, second = balancer.nodes
+
+        balancer.mark_down(second)
+        balancer.mark_down(first)
+
+        self.assertEqual(second, balancer.select())
+        self.assertEqual(None, balancer.select(exclude=[first, second]))
+
+
+def _packet(seq, payload):
+    return struct.pack(b'<I', len(payload))[:3] + struct.pack(b'B', seq) + payload
+
+
+def _lenenc(value):
+    return struct.pack(b'B', len(value)) + value
+
+
+class FakeSearchd(threading.Thread):
+    """
+    Принимает одно подключение по протоколу MySQL и отвечает на каждый
+    запрос одними и теми же наборами результатов
+    """
+    def __init__(self, *results):
+        super(FakeSearchd, self).__init__()
+        self.daemon = True
+        self.results = results
+        self.queries = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        conn = self.sock.accept()[0]
+        f = conn.makefile('rb')
+
+        def read():
+            header = bytearray(f.read(4))
+            return f.read(header[0] | header[1] << 8 | header[2] << 16)
+
+        conn.sendall(_packet(0, b'\x0a2.0.6-release\x00' + b'\x01\x00\x00\x00' + b'x' * 8 + b'\x00' * 24))
+        read()
+        conn.sendall(_packet(2, b'\x00\x00\x00\x02\x00\x00\x00'))
+
+        while True:
+            packet = read()
+            if not packet or packet[:1] == b'\x01':
+                break
+            self.queries.append(packet[1:].decode('utf-8'))
+
+            data = []
+            seq = 1
+            for i, (columns, rows) in enumerate(self.results):
+                status = b'\x08\x00' if i < len(self.results) - 1 else b'\x00\x00'
+                packets = [struct.pack(b'B', len(columns))]
+                for name, column_type in columns:
+                    packets.append(b''.join(_lenenc(x) for x in [b'def', b'', b'', b'', name, name])
+                                   + b'\x0c\x21\x00\x00\x00\x00\x00' + struct.pack(b'B', column_type) + b'\x00' * 5)
+                packets.append(b'\xfe\x00\x00\x02\x00')
+                for row in rows:
+                    packets.append(b''.join(b'\xfb' if v is None else _lenenc(v) for v in row))
+                packets.append(b'\xfe\x00\x00' + status)
+                for p in packets:
+                    data.append(_packet(seq, p))
+                    seq += 1
+            conn.sendall(b''.join(data))
+        conn.close()
+        self.sock.close()
+
+
+class TestNativeBackend(TestCase):
+
+    def test_escape(self):
+        self.assertEqual("'it\\'s\\n'", native.escape('it\'s\n'))
+        self.assertEqual("'поиск'", native.escape('поиск'.encode('utf-8')))
+        self.assertEqual('NULL', native.escape(None))
+        self.assertEqual('1', native.escape(True))
+        self.assertEqual('10', native.escape(10))
+
+    def test_query(self):
+        server = FakeSearchd(
+            ([(b'id', 8), (b'title', 253), (b'price', 4)], [(b'1', b'first', b'1.5'), (b'2', None, b'2')]),
+            ([(b'Variable_name', 253), (b'Value', 253)], [(b'total', b'2')]),
+        )
+        server.start()
+
+        backend = native.Backend()
+        conn = backend.connect('127.0.0.1', server.port)
+        cursor = conn.cursor()
+        backend.execute(cursor, 'SELECT * FROM idx WHERE MATCH(%s); SHOW META', ["it's"])
+
+        self.assertEqual(["SELECT * FROM idx WHERE MATCH('it\\'s'); SHOW META"], server.queries)
+        self.assertEqual(['id', 'title', 'price'], [d[0] for d in cursor.description])
+        self.assertEqual(2, cursor.rowcount)
+        self.assertEqual([(1, b'first', 1.5), (2, None, 2.0)], cursor.fetchall())
+
+        self.assertTrue(cursor.nextset())
+        self.assertEqual((b'total', b'2'), cursor.fetchone())
+        self.assertEqual(None, cursor.nextset())
+
+        self.assertEqual(3, backend.stats['rows'])
+        self.assertEqual(1, backend.stats['queries'])
+
+        conn.close()
+        server.join(1)
+        self.assertFalse(server.is_alive())
+
+
+class TestSphinxQuery(TestCase):
+
+    def test_parse_meta(self):
+        q = SphinxQuery()
+        q.description = (('id', 8), ('title', 253))
+
+        meta = q._parse_meta([
+            ('total', '2'), ('total_found', '10'), ('time', '0.001'),
+            ('keyword[0]', 'one'), ('docs[0]', '5'), ('hits[0]', '7'),
+            ('keyword[1]', 'two'), ('docs[1]', '1'), ('hits[1]', '2'),
+        ])
+
+        self.assertDictEqual({
+            'total': '2', 'total_found': '10', 'time': '0.001',
+            'words': {
+                'one': {'docs': '5', 'hits': '7'},
+                'two': {'docs': '1', 'hits': '2'},
+            },
+            'fields': {'id': 0, 'title': 1},
+        }, meta)
+
+    def test_single_round_trip(self):
+        server = FakeSearchd(
+            ([(b'id', 8), (b'title', 253)], [(b'1', b'first'), (b'2', b'second')]),
+            ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'2')]),
+        )
+        server.start()
+
+        handler = ConnectionHandler([dict(host='127.0.0.1', port=server.port)], backend='native')
+        default_handler, sphinx_query.conn_handler = sphinx_query.conn_handler, handler
+        try:
+            q = SphinxQuery('SELECT * FROM index WHERE MATCH(%s)', ['test'])
+            self.assertEqual(b'2', q.count())
+            self.assertEqual([(1, b'first'), (2, b'second')], list(q))
+            self.assertDictEqual({'id': 0, 'title': 1}, q.meta['fields'])
+        finally:
+            sphinx_query.conn_handler = default_handler
+            handler.balancer.nodes[0].pool.clear()
+
+        server.join(1)
+        self.assertEqual(["SELECT * FROM index WHERE MATCH('test'); SHOW META"], server.queries)
+
+
+class FakeSearchdMixin(object):
+
+    def _serve(self, *results):
+        server = FakeSearchd(*results)
+        self._serve_nodes(server)
+        return server
+
+    def _serve_nodes(self, *servers):
+        for server in servers:
+            server.start()
+
+        handler = ConnectionHandler([dict(host='127.0.0.1', port=server.port) for server in servers], backend='native')
+        default_handler, sphinx_query.conn_handler = sphinx_query.conn_handler, handler
+
+        def restore():
+            sphinx_query.conn_handler = default_handler
+            for node in handler.balancer.nodes:
+                node.pool.clear()
+            for server in servers:
+                server.join(1)
+
+        self.addCleanup(restore)
+
+
+class WorkerPoolMixin(object):
+
+    def _use_pool(self, size):
+        # свой пул потоков заданного размера на время теста
+        threads, pool = workers.SPHINX_WORKER_THREADS, workers._worker_pool
+        workers.SPHINX_WORKER_THREADS, workers._worker_pool = size, None
+
+        def restore():
+            if workers._worker_pool is not None:
+                workers._worker_pool.terminate()
+            workers.SPHINX_WORKER_THREADS, workers._worker_pool = threads, pool
+
+        self.addCleanup(restore)
+
+    def _use_refresh_pool(self, size):
+        # свой пул фоновых обновлений заданного размера на время теста
+        saved = workers.SPHINX_RESULT_CACHE_REFRESH_THREADS, workers._refresh_pool, workers._refresh_slots
+        workers.SPHINX_RESULT_CACHE_REFRESH_THREADS, workers._refresh_pool = size, None
+
+        def restore():
+            if workers._refresh_pool is not None:
+                workers._refresh_pool.terminate()
+            workers.SPHINX_RESULT_CACHE_REFRESH_THREADS, workers._refresh_pool, workers._refresh_slots = saved
+
+        self.addCleanup(restore)
+
+
+class TestWorkers(WorkerPoolMixin, TestCase):
+
+    def test_run_refresh(self):
+        self._use_refresh_pool(1)
+        started, release, done = threading.Event(), threading.Event(), threading.Event()
+
+        def refresh():
+            started.set()
+            release.wait(5)
+
+        # единственный поток занят: обновление не ставится в очередь
+        self.assertTrue(workers.run_refresh(refresh))
+        self.assertTrue(started.wait(5))
+        self.assertFalse(workers.run_refresh(done.set))
+
+        release.set()
+        until = time.time() + 5
+        while not workers.run_refresh(done.set) and time.time() < until:
+            time.sleep(0.01)
+        self.assertTrue(done.wait(5))
+
+
+class TestBatch(FakeSearchdMixin, TestCase):
+
+    def test_fetch_many(self):
+        server = self._serve(
+            ([(b'id', 8)], [(b'1',), (b'2',)]),
+            ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'2')]),
+            ([(b'id', 8)], [(b'3',)]),
+            ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'1')]),
+        )
+
+        first = SphinxQuery('SELECT * FROM one WHERE MATCH(%s)', ['first'])
+        second = SphinxQuery('SELECT * FROM two WHERE MATCH(%s)', ['second'])
+        SphinxQuery.fetch_many([first, second])
+
+        self.assertEqual([(1,), (2,)], list(first))
+        self.assertEqual(b'2', first.count())
+        self.assertEqual([(3,)], list(second))
+        self.assertEqual(b'1', second.count())
+
+        self.assertEqual(["SELECT * FROM one WHERE MATCH('first'); SHOW META; "
+                          "SELECT * FROM two WHERE MATCH('second'); SHOW META"], server.queries)
+
+    def test_batch(self):
+        for x in range(0, 3):
+            any_model(Search, related=any_model(Related), m2m=any_model(M2M))
+
+        first, second, third = [ds.SphinxQuerySet(model=Search)._encode_document_id(obj.pk)
+                                for obj in Search.objects.order_by('pk')]
+        meta = ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'2')])
+        server = self._serve(
+            ([(b'id', 8)], [(str(third).encode(),), (str(first).encode(),)]), meta,
+            ([(b'id', 8)], [(str(first).encode(),), (str(second).encode(),)]), meta,
+        )
+
+        qs = ds.SphinxQuerySet(model=Search, snippets=False)
+        with self.assertNumQueries(1):
+            results, related = ds.SphinxQuerySet.batch(qs.query('one'), qs.query('two'))
+
+        self.assertEqual(1, len(server.queries))
+        self.assertEqual([third, first], [ds.SphinxQuerySet(model=Search)._encode_document_id(obj.pk)
+                                          for obj in results])
+        self.assertEqual(2, related.count())
+        self.assertTrue(list(results)[1]._current_object is list(related)[0]._current_object)
+
+    def test_batch_fan_out(self):
+        columns = [(b'id', 8), (b'weight', 3), (b'uint', 3)]
+        meta = lambda total_found: ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', total_found)])
+        server = self._serve(
+            (columns, [(b'1', b'1', b'9'), (b'2', b'1', b'4')]), meta(b'2'),
+            (columns, [(b'3', b'1', b'7')]), meta(b'1'),
+            (columns, [(b'4', b'1', b'5')]), meta(b'1'),
+        )
+
+        # части выборки с fan_out() уходят в общий пакет и сливаются после него
+        qs = ds.SphinxQuerySet(index='one two').values_list('uint', flat=True)
+        merged, single = ds.SphinxQuerySet.batch(qs.fan_out().order_by('-uint'), qs.add_index('three').fan_out(False))
+
+        self.assertEqual([9, 7, 4], list(merged))
+        self.assertEqual(3, merged.count())
+        self.assertEqual([5], list(single))
+        self.assertEqual(1, len(server.queries))
+        self.assertEqual(3, server.queries[0].count('SHOW META'))
+
+
+class TestFetchRows(FakeSearchdMixin, TestCase):
+
+    def test_fetchmany(self):
+        self._serve(
+            ([(b'id', 8)], [(b'1',), (b'2',), (b'3',)]),
+            ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'3')]),
+        )
+        fetch_size, sphinx_query.SPHINX_FETCH_SIZE = sphinx_query.SPHINX_FETCH_SIZE, 2
+        self.addCleanup(setattr, sphinx_query, 'SPHINX_FETCH_SIZE', fetch_size)
+
+        q = SphinxQuery('SELECT * FROM index')
+        self.assertEqual([(1,), (2,)], q.fetchmany(2))
+        self.assertEqual((3,), q.next())
+        self.assertEqual([], q.fetchmany(2))
+        self.assertEqual(b'3', q.count())
+
+
+class TestLazyMeta(FakeSearchdMixin, TestCase):
+
+    def test_lazy_meta(self):
+        server = self._serve(
+            ([(b'id', 8), (b'title', 253)], [(b'1', b'first')]),
+            ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'15')]),
+        )
+
+        q = SphinxQuery('SELECT * FROM index LIMIT 0, 20', meta_query=('SELECT * FROM index LIMIT 0, 1', []))
+        self.assertEqual({'id': 0, 'title': 1}, q.fields)
+        self.assertEqual(['SELECT * FROM index LIMIT 0, 20'], server.queries)
+
+        self.assertEqual(b'15', q.count())
+        self.assertEqual({'id': 0, 'title': 1}, q.meta['fields'])
+        self.assertEqual(['SELECT * FROM index LIMIT 0, 20', 'SELECT * FROM index LIMIT 0, 1; SHOW META'],
+                         server.queries)
+
+    def test_meta_query(self):
+        qs = ds.SphinxQuerySet(index='index', query_options={}).query('test')
+        qs._set_limits(20, 40)
+
+        q = qs._get_query()
+        self.assertTrue(q._query.endswith(" LIMIT 20, 20 OPTION ranker=bm25"))
+        self.assertTrue(q._meta_query[0].endswith(" LIMIT 0, 1 OPTION ranker=bm25"))
+        self.assertEqual(['test'], q._meta_query[1])
+
+        self.assertEqual(None, qs._get_query(meta=True)._meta_query)
+
+    def test_len(self):
+        server = self._serve(
+            ([(b'id', 8)], []),
+            ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'15')]),
+        )
+
+        qs = ds.SphinxQuerySet(index='index', query_options={})
+        # len() - количество найденных документов, как и count(); list()
+        # получает его тем же запросом, что и документы
+        self.assertEqual([], list(qs))
+        self.assertEqual(15, len(qs))
+        self.assertEqual(['SELECT * FROM index    OPTION ranker=bm25; SHOW META'], server.queries)
+
+        self.assertEqual([], list(qs[5:10]))
+        self.assertEqual(2, len(server.queries))
+        self.assertTrue(server.queries[1].endswith(' LIMIT 5, 5 OPTION ranker=bm25; SHOW META'))
+
+
+class TestCount(FakeSearchdMixin, TestCase):
+
+    def test_count(self):
+        server = self._serve(
+            ([(b'id', 8)], [(b'1',)]),
+            ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'15')]),
+        )
+
+        qs = ds.SphinxQuerySet(index='index', query_options={})
+        with self.assertNumQueries(0):
+            self.assertEqual(15, qs.count())
+            self.assertEqual(15, qs.count())
+
+        self.assertEqual(1, len(server.queries))
+        self.assertTrue(server.queries[0].endswith(' LIMIT 0, 1 OPTION ranker=bm25; SHOW META'))
+        self.assertEqual(None, qs._result_cache)
+
+    def test_exists(self):
+        server = self._serve(([(b'id', 8)], []))
+
+        qs = ds.SphinxQuerySet(index='index', query_options={})
+        self.assertFalse(qs.exists())
+        self.assertFalse(' SHOW META' in server.queries[0])
+
+        self.assertFalse(qs.none().exists())
+        self.assertEqual(0, qs.none().count())
+        self.assertEqual(1, len(server.queries))
+
+
+class TestValues(FakeSearchdMixin, TestCase):
+
+    def test_values(self):
+        server = self._serve(
+            ([(b'id', 8), (b'weight', 3), (b'uint', 3)],
+             [(b'%i' % (5 << 52 | 7), b'90', b'1'), (b'%i' % (6 << 52 | 8), b'50', b'2')]),
+            ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'2')]),
+        )
+
+        qs = ds.SphinxQuerySet(index='index')
+        with self.assertNumQueries(0):
+            self.assertEqual([{'id': 7, 'uint': 1}, {'id': 8, 'uint': 2}], list(qs.values('id', 'uint')))
+            self.assertEqual([(90, 5), (50, 6)], list(qs.values_list('weight', 'content_type')))
+            self.assertEqual([1, 2], list(qs.values_list('uint', flat=True)))
+            self.assertEqual([(7, 5), (8, 6)], list(qs.ids()))
+            self.assertEqual([{'id': 7, 'weight': 90, 'uint': 1, 'content_type': 5},
+                              {'id': 8, 'weight': 50, 'uint': 2, 'content_type': 6}], list(qs.values()))
+
+        self.assertTrue(server.queries[3].startswith('SELECT `id` FROM index'))
+        self.assertRaises(SearchError, list, qs.values('unknown'))
+
+        # колонки выражений в результат ids() не попадают
+        self.assertEqual([(7, 5), (8, 6)], list(qs.fields(score='weight()*2').order_by('-score').ids()))
+        self.assertTrue(server.queries[-1].startswith('SELECT `id` , weight()*2 AS `score` FROM index'))
+        self.assertRaises(TypeError, qs.values_list, 'id', 'uint', flat=True)
+
+
+class TestIterator(FakeSearchdMixin, TestCase):
+
+    def test_iterator(self):
+        for x in range(0, 3):
+            any_model(Search, related=any_model(Related), m2m=any_model(M2M))
+
+        qs = ds.SphinxQuerySet(model=Search, snippets=False)
+        ids = [qs._encode_document_id(obj.pk) for obj in Search.objects.order_by('-pk')]
+        self._serve(
+            ([(b'id', 8)], [(str(id).encode(),) for id in ids]),
+            ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'3')]),
+        )
+
+        with self.assertNumQueries(2):
+            results = [qs._encode_document_id(obj.pk) for obj in qs.iterator(chunk_size=2)]
+
+        self.assertEqual(ids, results)
+        self.assertEqual(None, qs._result_cache)
+
+
+class TestHydrate(FakeSearchdMixin, TestCase):
+
+    def test_hydrate(self):
+        for x in range(0, 3):
+            any_model(Search, related=any_model(Related), m2m=any_model(M2M))
+
+        qs = ds.SphinxQuerySet(model=Search, snippets=False)
+        ids = [qs._encode_document_id(obj.pk) for obj in Search.objects.all()]
+        self._serve(([(b'id', 8)], [(str(id).encode(),) for id in ids]))
+
+        qs = qs.hydrate(select_related='related', defer=['text'])
+        with self.assertNumQueries(1):
+            names = [obj.related.name for obj in qs]
+        self.assertEqual([obj.related.name for obj in Search.objects.all()], names)
+
+    def test_options(self):
+        qs = ds.SphinxQuerySet(model=Search).hydrate(only=['name']).hydrate(Search, prefetch_related='m2m')
+
+        hydration = qs._get_hydration_query_set(Search)
+        self.assertEqual(['m2m'], list(hydration._prefetch_related_lookups))
+        self.assertEqual((set(['name']), False), hydration.query.deferred_loading)
+
+        self.assertRaises(TypeError, qs.hydrate, order_by='name')
+
+
+class TestFacets(FakeSearchdMixin, TestCase):
+
+    def test_facets(self):
+        server = self._serve(
+            ([(b'id', 8), (b'uint', 3), (b'@count', 3)], [(b'7', b'5', b'10'), (b'3', b'1', b'4')]),
+            ([(b'id', 8), (b'facet', 3), (b'@count', 3)], [(b'1', b'1', b'8'), (b'2', b'0', b'6')]),
+        )
+
+        qs = ds.SphinxQuerySet(index='search', query_options={})
+        facets = qs.query('test').facets('uint', float=[100, 10])
+
+        self.assertEqual([(5, 10), (1, 4)], list(facets['uint'].items()))
+        self.assertEqual([((None, 10), 6), ((10, 100), 8), ((100, None), 0)], list(facets['float'].items()))
+
+        self.assertEqual(1, len(server.queries))
+        self.assertFalse('SHOW META' in server.queries[0])
+        uint, price = server.queries[0].split('; ')
+        self.assertTrue(uint.startswith("SELECT * FROM search WHERE MATCH('test') GROUP BY `uint` "
+                                        "ORDER BY @count DESC  LIMIT 0, %i OPTION" % SPHINX_MAX_MATCHES))
+        self.assertTrue(price.startswith("SELECT * , INTERVAL(`float`, 10, 100) AS `facet` FROM search "
+                                         "WHERE MATCH('test') GROUP BY `facet` ORDER BY @count DESC  LIMIT 0, "))
+
+
+class StubQuery(SphinxQuery):
+    # готовые результаты вместо обращения к searchd
+    def __init__(self, rows):
+        super(StubQuery, self).__init__('SELECT * FROM stub')
+        self._stub_rows = rows
+
+    def _get_results(self):
+        time.sleep(0.01)
+        self.description = (('id', 8), ('weight', 3))
+        self._meta = dict(total_found=len(self._stub_rows), fields={'id': 0, 'weight': 1})
+        self._rows = iter(self._stub_rows)
+
+
+class TestFanOut(WorkerPoolMixin, FakeSearchdMixin, TestCase):
+
+    def _meta(self, total_found, docs):
+        return ([(b'Variable_name', 253), (b'Value', 253)],
+                [(b'total', total_found), (b'total_found', total_found), (b'time', b'0.010'),
+                 (b'keyword[0]', b'test'), (b'docs[0]', docs), (b'hits[0]', docs)])
+
+    def test_merge(self):
+        columns = [(b'id', 8), (b'weight', 3), (b'uint', 3)]
+        one = FakeSearchd((columns, [(b'1', b'90', b'5'), (b'2', b'50', b'1'), (b'3', b'10', b'4')]),
+                          self._meta(b'3', b'3'))
+        two = FakeSearchd((columns, [(b'4', b'70', b'2'), (b'5', b'50', b'3')]),
+                          self._meta(b'12', b'20'))
+        self._serve_nodes(one, two)
+
+        parts = [SphinxQuery('SELECT * FROM one'), SphinxQuery('SELECT * FROM two')]
+        q = sphinx_query.MergedSphinxQuery(parts, offset=1, limit=3)
+
+        self.assertEqual([4, 2, 5], [row[0] for row in q])
+        self.assertEqual(15, q.count())
+        self.assertEqual({'test': {'docs': 23, 'hits': 23}}, q.meta['words'])
+        self.assertEqual(1, len(one.queries))
+        self.assertEqual(1, len(two.queries))
+
+    def test_duplicates(self):
+        columns = [(b'id', 8), (b'weight', 3), (b'uint', 3)]
+        one = FakeSearchd((columns, [(b'1', b'90', b'5'), (b'2', b'50', b'1'), (b'3', b'10', b'4')]),
+                          self._meta(b'3', b'3'))
+        two = FakeSearchd((columns, [(b'2', b'80', b'9'), (b'4', b'70', b'2')]),
+                          self._meta(b'2', b'2'))
+        self._serve_nodes(one, two)
+
+        # документ из обоих индексов берётся из последнего и считается один раз
+        parts = [SphinxQuery('SELECT * FROM one'), SphinxQuery('SELECT * FROM two')]
+        q = sphinx_query.MergedSphinxQuery(parts, limit=3, max_matches=3)
+
+        self.assertEqual([(1, 5), (2, 9), (4, 2)], [(row[0], row[2]) for row in q])
+        self.assertEqual(4, q.count())
+        self.assertEqual(3, q.meta['total'])
+
+    def test_parts(self):
+        qs = ds.SphinxQuerySet(index='one two', fan_out=True).query('test').order_by('-uint')
+        qs._set_limits(10, 20)
+        q = qs._get_query()
+
+        self.assertIsInstance(q, sphinx_query.MergedSphinxQuery)
+        self.assertEqual([('uint', True)], q._order)
+        self.assertEqual((10, 10), (q._offset, q._limit))
+        self.assertEqual(['one', 'two'], [part._query.split()[3] for part in q._parts])
+        self.assertTrue('LIMIT 0, 30' in q._parts[0]._query)
+
+        self.assertNotIsInstance(qs.fan_out(False)._get_query(), sphinx_query.MergedSphinxQuery)
+        self.assertNotIsInstance(qs.group_by('uint')._get_query(), sphinx_query.MergedSphinxQuery)
+
+    def test_small_pool(self):
+        # запросов в пуле больше, чем его потоков: части выполняются в них самих
+        self._use_pool(2)
+
+        def fetch():
+            parts = [StubQuery([(1, 90)]), StubQuery([(2, 50), (3, 10)])]
+            return [row[0] for row in sphinx_query.MergedSphinxQuery(parts)]
+
+        pending = [workers.run_async(fetch) for x in range(0, 3)]
+        self.assertEqual([[1, 2, 3]] * 3, [result.get(5) for result in pending])
+        self.assertEqual([1, 2, 3], fetch())
+
+
+class TestIndexRegistry(FakeSearchdMixin, TestCase):
+
+    def setUp(self):
+        super(TestIndexRegistry, self).setUp()
+        ContentType.objects.clear_cache()
+        registry.clear()
+
+    def test_schema(self):
+        with self.assertNumQueries(1):
+            schema = registry.get_index('testapp_search')
+            self.assertEqual('testapp_search', all_indexes())
+
+        self.assertIs(Search, schema.model)
+        self.assertIs(schema, registry.get_schema(Search))
+        self.assertEqual(['id', 'text', 'datetime', 'bool', 'uint', 'stored_string',
+                          'excluded_field', 'related', 'm2m'], schema.fields)
+        self.assertEqual(['stored_string'], schema.stored_attributes)
+        self.assertEqual('timestamp', schema.attr_types['datetime'])
+        self.assertEqual('string', schema.attr_types['stored_string'])
+        self.assertEqual('uint', schema.attr_types['related'])
+        self.assertIsNone(registry.get_index('unknown'))
+
+    def test_no_metadata_queries(self):
+        obj = any_model(Search, related=any_model(Related), m2m=any_model(M2M))
+        registry.populate()
+
+        qs = ds.SphinxQuerySet(index='testapp_search', snippets=False)
+        with self.assertNumQueries(0):
+            doc_id = ds.SphinxQuerySet(model=Search)._encode_document_id(obj.pk)
+            self.assertIs(Search, registry.get_model(qs._decode_document_id(doc_id)[1]))
+
+        self._serve(([(b'id', 8)], [(str(doc_id).encode(),)]))
+        with self.assertNumQueries(1):
+            self.assertEqual([obj.pk], [o.pk for o in qs])
+        self.assertIs(Search, qs.model)
+
+    def test_unregistered_model(self):
+        registry.populate()
+        with self.assertNumQueries(1):
+            ct = registry.get_content_type_id(Related)
+            self.assertIs(Related, registry.get_model(ct))
+            self.assertEqual(ct, registry.get_content_type_id(Related))
+
+
+class TestParallelHydration(FakeSearchdMixin, TestCase):
+
+    def setUp(self):
+        super(TestParallelHydration, self).setUp()
+        self.calls = []
+        self._run_async = sphinx_queryset.run_async
+        sphinx_queryset.run_async = self._fake_run_async
+
+    def tearDown(self):
+        sphinx_queryset.run_async = self._run_async
+        super(TestParallelHydration, self).tearDown()
+
+    def _fake_run_async(self, func, *args, **kwargs):
+        # выполняет сразу, в этом же потоке: тестовая БД не видна другим потокам
+        self.calls.append((args[0], kwargs))
+        result = func(*args, **kwargs)
+        return type(b'Result', (object,), dict(get=lambda self: result))()
+
+    def test_parallel(self):
+        related = [any_model(Related) for x in range(0, 2)]
+        search = any_model(Search, related=related[0], m2m=any_model(M2M))
+        encode = lambda model, pk: registry.get_content_type_id(model) << DOCUMENT_ID_SHIFT | pk
+
+        docs = [encode(Related, related[1].pk), encode(Search, search.pk), encode(Related, related[0].pk)]
+        self._serve(
+            ([(b'id', 8)], [(str(id).encode(),) for id in docs]),
+            ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'3')]),
+        )
+
+        qs = ds.SphinxQuerySet(index='testapp_search testapp_related', snippets=False)
+        with self.assertNumQueries(2):
+            self.assertEqual([related[1], search, related[0]], [p._get_current_object() for p in qs.parallel_hydration()])
+        self.assertEqual(set([Related, Search]), set(model for model, kwargs in self.calls))
+        self.assertEqual([dict(close=True)] * 2, [kwargs for model, kwargs in self.calls])
+
+        self.calls = []
+        list(qs)
+        self.assertEqual([], self.calls)
+
+    def test_in_worker(self):
+        related = any_model(Related)
+        search = any_model(Search, related=related, m2m=any_model(M2M))
+        encode = lambda model, pk: registry.get_content_type_id(model) << DOCUMENT_ID_SHIFT | pk
+
+        docs = [encode(Search, search.pk), encode(Related, related.pk)]
+        self._serve(([(b'id', 8)], [(str(id).encode(),) for id in docs]))
+
+        # в потоке пула объекты запрашиваются в нём же
+        worker, workers._local.worker = getattr(workers._local, 'worker', False), True
+        self.addCleanup(setattr, workers._local, 'worker', worker)
+
+        qs = ds.SphinxQuerySet(index='testapp_search testapp_related', snippets=False).parallel_hydration()
+        self.assertEqual([search, related], [p._get_current_object() for p in qs])
+        self.assertEqual([], self.calls)
+
+
+class TestObjectCache(FakeSearchdMixin, TestCase):
+
+    def setUp(self):
+        super(TestObjectCache, self).setUp()
+        self.options = dict(Search.__sphinx_options__)
+        Search.__sphinx_options__['object_cache'] = True
+        post_save.connect(invalidate_object, sender=Search)
+        object_cache.clear()
+
+    def tearDown(self):
+        post_save.disconnect(invalidate_object, sender=Search)
+        Search.__sphinx_options__.clear()
+        Search.__sphinx_options__.update(self.options)
+        object_cache.clear()
+        super(TestObjectCache, self).tearDown()
+
+    def test_lru(self):
+        cache = LRUCache(max_size=2, ttl=10)
+        cache.set_many({'a': 1, 'b': 2})
+        self.assertEqual(1, cache.get('a'))
+        cache.set('c', 3)
+        self.assertEqual({'a': 1, 'c': 3}, cache.get_many(['a', 'b', 'c']))
+
+        cache.set('d', 4, ttl=-1)
+        self.assertIsNone(cache.get('d'))
+
+    def test_hydration(self):
+        objs = [any_model(Search, related=any_model(Related), m2m=any_model(M2M)) for x in range(0, 2)]
+        qs = ds.SphinxQuerySet(model=Search, snippets=False)
+        ids = [(str(qs._encode_document_id(obj.pk)).encode(),) for obj in objs]
+        self._serve(
+            ([(b'id', 8)], ids),
+            ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'2')]),
+        )
+
+        with self.assertNumQueries(1):
+            self.assertEqual(objs, [p._get_current_object() for p in qs._clone()])
+        with self.assertNumQueries(0):
+            found = [p._get_current_object() for p in qs._clone()]
+        self.assertEqual(objs, found)
+        self.assertIsNot(found[0], object_cache.get_many(Search, [objs[0].pk])[objs[0].pk])
+
+        objs[1].name = 'changed'
+        objs[1].save()
+        with self.assertNumQueries(1):
+            self.assertEqual('changed', list(qs._clone())[1].name)
+
+    def test_copies(self):
+        obj = any_model(Search, related=any_model(Related), m2m=any_model(M2M))
+        object_cache.set_many(Search, {obj.pk: Search.objects.select_related('related').get(pk=obj.pk)})
+
+        # копии не делят ни _state, ни закэшированные связанные объекты
+        first, second = [object_cache.get_many(Search, [obj.pk])[obj.pk] for x in range(0, 2)]
+        self.assertIsNot(first._state, second._state)
+        first.related.name = 'changed'
+        first._state.db = 'other'
+        with self.assertNumQueries(0):
+            self.assertEqual(obj.related.name, second.related.name)
+        self.assertEqual('default', second._state.db)
+
+    def test_databases(self):
+        obj = any_model(Search, related=any_model(Related), m2m=any_model(M2M))
+        object_cache.set_many(Search, {obj.pk: obj})
+        object_cache.set_many(Search, {obj.pk: obj}, using='other')
+        self.assertEqual({}, object_cache.get_many(Search, [obj.pk], using='replica'))
+
+        # сигнал сбрасывает объект только в той БД, где он сохранён
+        invalidate_object(Search, obj, using='other')
+        self.assertEqual({}, object_cache.get_many(Search, [obj.pk], using='other'))
+        self.assertEqual([obj.pk], list(object_cache.get_many(Search, [obj.pk])))
+
+
+class TestResultCache(FakeSearchdMixin, TestCase):
+
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        result_cache.clear()
+
+    def tearDown(self):
+        result_cache.clear()
+        super(TestResultCache, self).tearDown()
+
+    def _meta(self, total_found):
+        return ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', total_found)])
+
+    def test_cached(self):
+        server = self._serve(([(b'id', 8), (b'uint', 3)], [(b'1', b'5'), (b'2', b'7')]), self._meta(b'2'))
+
+        qs = ds.SphinxQuerySet(index='one two').query('test').values_list('uint', flat=True).cache(30)
+        self.assertEqual(2, qs.count())
+        self.assertEqual([5, 7], list(qs))
+        self.assertEqual(2, len(server.queries))
+
+        # тот же запрос с другими пробелами
+        self.assertEqual(2, qs._clone().count())
+        self.assertEqual([5, 7], list(qs._clone(_order_by='  ')))
+        self.assertEqual(2, len(server.queries))
+
+        result_cache.bump('two')
+        self.assertEqual([5, 7], list(qs._clone()))
+        self.assertEqual(3, len(server.queries))
+
+        self.assertEqual([5, 7], list(qs.cache(None)))
+        self.assertEqual(4, len(server.queries))
+
+    def test_lazy_meta(self):
+        server = self._serve(([(b'id', 8), (b'uint', 3)], [(b'1', b'5')]))
+
+        qs = ds.SphinxQuerySet(index='one').values_list('uint', flat=True).cache(30)
+        [uint for uint in qs]
+        [uint for uint in qs._clone()]
+        self.assertEqual(1, len(server.queries))
+        self.assertFalse('SHOW META' in server.queries[0])
+
+    def test_stale(self):
+        server = self._serve(([(b'id', 8), (b'uint', 3)], [(b'1', b'5')]), self._meta(b'1'))
+        refreshed = []
+        run_refresh, sphinx_cache.run_refresh = sphinx_cache.run_refresh, lambda func: refreshed.append(func) or True
+        self.addCleanup(setattr, sphinx_cache, 'run_refresh', run_refresh)
+
+        stale_hits = result_cache.stats['stale_hits']
+        qs = ds.SphinxQuerySet(index='one').values_list('uint', flat=True).cache(ttl=0.01, stale_ttl=30)
+        self.assertEqual([5], list(qs))
+        time.sleep(0.02)
+
+        # устаревший результат отдаётся сразу, обновление - одно на ключ
+        self.assertEqual([5], list(qs._clone()))
+        self.assertEqual([5], list(qs._clone()))
+        self.assertEqual(1, len(refreshed))
+        self.assertEqual(1, len(server.queries))
+
+        refreshed[0]()
+        self.assertEqual(2, len(server.queries))
+        self.assertEqual([5], list(qs._clone()))
+        self.assertEqual(2, len(server.queries))
+        self.assertEqual(stale_hits + 2, result_cache.stats['stale_hits'])
+
+    def test_stale_deadline(self):
+        server = self._serve(([(b'id', 8), (b'uint', 3)], [(b'1', b'5')]), self._meta(b'1'))
+        refreshed = []
+        run_refresh, sphinx_cache.run_refresh = sphinx_cache.run_refresh, lambda func: refreshed.append(func) or True
+        self.addCleanup(setattr, sphinx_cache, 'run_refresh', run_refresh)
+
+        qs = ds.SphinxQuerySet(index='one').values_list('uint', flat=True).cache(ttl=0.01, stale_ttl=30)
+        self.assertEqual([5], list(qs))
+        time.sleep(0.02)
+
+        # срок выборки (как у fetch_async) к фоновому обновлению не относится
+        self.assertEqual([5], list(qs._clone(_deadline=time.time() + 0.05).timeout(0.05)))
+        time.sleep(0.06)
+        refreshed[0]()
+        self.assertEqual(2, len(server.queries))
+
+    def test_stale_stats(self):
+        server = self._serve(([(b'id', 8)], [(b'1',)]), self._meta(b'12'))
+        refreshed = []
+        run_refresh, sphinx_cache.run_refresh = sphinx_cache.run_refresh, lambda func: refreshed.append(func) or True
+        self.addCleanup(setattr, sphinx_cache, 'run_refresh', run_refresh)
+
+        qs = ds.SphinxQuerySet(index='one').cache(ttl=0.01, stale_ttl=30)
+        with search_budget(10):
+            self.assertEqual(12, qs.count())
+            time.sleep(0.02)
+            self.assertEqual(12, qs._clone().count())
+
+        # обновление выполняется позже, без ограничения из бюджета вызвавшего потока
+        refreshed[0]()
+        self.assertEqual(2, len(server.queries))
+        self.assertFalse('max_query_time=' in server.queries[0])
+        self.assertFalse('max_query_time=' in server.queries[1])
+
+    def test_stale_busy(self):
+        server = self._serve(([(b'id', 8), (b'uint', 3)], [(b'1', b'5')]), self._meta(b'1'))
+        run_refresh, sphinx_cache.run_refresh = sphinx_cache.run_refresh, lambda func: False
+        self.addCleanup(setattr, sphinx_cache, 'run_refresh', run_refresh)
+
+        dropped = result_cache.stats['dropped']
+        qs = ds.SphinxQuerySet(index='one').values_list('uint', flat=True).cache(ttl=0.01, stale_ttl=30)
+        self.assertEqual([5], list(qs))
+        time.sleep(0.02)
+
+        # свободного потока нет: устаревший результат отдаётся, обновление пропускается
+        self.assertEqual([5], list(qs._clone()))
+        self.assertEqual([5], list(qs._clone()))
+        self.assertEqual(1, len(server.queries))
+        self.assertEqual(dropped + 2, result_cache.stats['dropped'])
+
+    def test_stats(self):
+        server = self._serve(([(b'id', 8)], [(b'1',)]), self._meta(b'12'))
+
+        qs = ds.SphinxQuerySet(index='one').cache(30)
+        self.assertEqual(12, qs.count())
+        self.assertEqual(12, qs._clone().count())
+        self.assertEqual(1, len(server.queries))
+
+    def test_budget(self):
+        server = self._serve(([(b'id', 8), (b'uint', 3)], [(b'1', b'5')]), self._meta(b'1'))
+
+        # max_query_time из бюджета меняется от запроса к запросу, ключ - нет
+        qs = ds.SphinxQuerySet(index='one').values_list('uint', flat=True).cache(30)
+        with search_budget(10):
+            self.assertEqual([5], list(qs))
+            time.sleep(0.01)
+            self.assertEqual([5], list(qs._clone()))
+            self.assertEqual(1, qs._clone().count())
+            time.sleep(0.01)
+            self.assertEqual(1, qs._clone().count())
+
+        # кэшируемый результат не урезан бюджетом и годится для выборок без него
+        self.assertEqual([5], list(qs._clone()))
+        self.assertEqual(1, qs._clone().count())
+        self.assertEqual(2, len(server.queries))
+        self.assertFalse('max_query_time=' in server.queries[0])
+        self.assertFalse('max_query_time=' in server.queries[1])
+
+    def test_budget_uncached(self):
+        server = self._serve(([(b'id', 8), (b'uint', 3)], [(b'1', b'5')]), self._meta(b'1'))
+
+        # без кэша searchd по-прежнему ограничивается бюджетом
+        qs = ds.SphinxQuerySet(index='one').values_list('uint', flat=True)
+        with search_budget(10):
+            self.assertEqual([5], list(qs))
+            self.assertEqual(1, qs._clone().count())
+
+        self.assertEqual(2, len(server.queries))
+        self.assertTrue('max_query_time=' in server.queries[0])
+        self.assertTrue('max_query_time=' in server.queries[1])
+
+    def test_single_flight_budget(self):
+        server = self._serve(([(b'id', 8), (b'uint', 3)], [(b'1', b'5')]), self._meta(b'1'))
+        keys = []
+        flight = result_cache._flight
+        do, flight.do = flight.do, lambda key, func, deadline=None: keys.append(key) or do(key, func, deadline)
+        self.addCleanup(setattr, flight, 'do', do)
+
+        # одновременные промахи с разным оставшимся временем объединяются по одному ключу
+        qs = ds.SphinxQuerySet(index='one').values_list('uint', flat=True).cache(30)
+        with search_budget(10):
+            self.assertEqual([5], list(qs))
+        result_cache.clear()
+        with search_budget(5):
+            self.assertEqual([5], list(qs._clone()))
+
+        self.assertEqual(2, len(server.queries))
+        self.assertEqual(server.queries[0], server.queries[1])
+        self.assertEqual(2, len(keys))
+        self.assertEqual(keys[0], keys[1])
+
+
+class TestSingleFlight(TestCase):
+
+    def test_do(self):
+        flight = SingleFlight()
+        calls = []
+        release = threading.Event()
+
+        def func():
+            calls.append(1)
+            release.wait(1)
+            return 42
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', func))) for x in range(0, 3)]
+        for thread in threads:
+            thread.start()
+        while not calls:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(1)
+
+        self.assertEqual([1], calls)
+        self.assertEqual([42] * 3, results)
+        self.assertEqual({}, flight._calls)
+
+    def test_error(self):
+        flight = SingleFlight()
+        self.assertRaises(ZeroDivisionError, flight.do, 'key', lambda: 1 / 0)
+        self.assertEqual(1, flight.do('key', lambda: 1))
+
+    def test_versions(self):
+        cache = ResultCache(backend='django.core.cache.backends.locmem.LocMemCache')
+        backend = cache._get_backend()
+        key = cache._version_key('one')
+        self.addCleanup(backend.delete, key)
+
+        timeouts = []
+        for name in ('add', 'set'):
+            method = getattr(backend, name)
+            setattr(backend, name, lambda key, value, timeout, method=method:
+                    timeouts.append(timeout) or method(key, value, timeout))
+
+        # версии хранятся дольше времени по-умолчанию, а пропавшая начинается заново
+        versions = cache.get_versions(['one'])
+        self.assertEqual(versions, cache.get_versions(['one']))
+        backend.delete(key)
+        cache.bump('one')
+        self.assertNotEqual(versions, cache.get_versions(['one']))
+        self.assertEqual([ResultCache.VERSION_TIMEOUT] * 2, timeouts)
+
+    def test_lease(self):
+        cache = ResultCache(backend='django.core.cache.backends.locmem.LocMemCache', lease=1)
+        backend = cache._get_backend()
+
+        # блокировку держит другой процесс, он и кладёт результат в кэш
+        backend.add('key:lock', 1, 1)
+        timer = threading.Timer(0.1, lambda: backend.set('key', (time.time() + 30, time.time() + 30, 'shared'), 30))
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        self.assertEqual('shared', cache.fetch('key', lambda: 'own', 30))
+        self.assertEqual(1, cache.stats['waits'])
+
+        self.assertEqual('own', cache.fetch('other', lambda: 'own', 30))
+        self.assertIsNone(backend.get('other:lock'))
+
+
+class TestNegativeCache(FakeSearchdMixin, TestCase):
+
+    def setUp(self):
+        super(TestNegativeCache, self).setUp()
+        self.settings = sphinx_queryset.SPHINX_NEGATIVE_CACHE_TTL, negative_cache.local.ttl
+        sphinx_queryset.SPHINX_NEGATIVE_CACHE_TTL = negative_cache.local.ttl = 30
+        negative_cache.clear()
+
+    def tearDown(self):
+        sphinx_queryset.SPHINX_NEGATIVE_CACHE_TTL, negative_cache.local.ttl = self.settings
+        negative_cache.clear()
+        super(TestNegativeCache, self).tearDown()
+
+    def test_empty(self):
+        server = self._serve(([(b'id', 8)], []), ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'0')]))
+
+        qs = ds.SphinxQuerySet(index='one').query('tset  typo')
+        self.assertEqual([], list(qs))
+        self.assertEqual(1, len(server.queries))
+
+        self.assertEqual([], list(qs._clone()))
+        self.assertEqual([], list(ds.SphinxQuerySet(index='one').query(' tset typo')[20:40]))
+        self.assertEqual(0, qs._clone().count())
+        self.assertFalse(qs._clone().exists())
+        self.assertEqual(1, len(server.queries))
+
+        result_cache.bump('one')
+        self.assertFalse(qs._clone().exists())
+        self.assertEqual(2, len(server.queries))
+
+    def test_offset(self):
+        server = self._serve(([(b'id', 8)], []), ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'15')]))
+
+        # пустая вторая страница не значит, что документов нет
+        qs = ds.SphinxQuerySet(index='one').query('test')
+        list(qs[10:20])
+        list(qs._clone())
+        self.assertEqual(2, len(server.queries))
+
+    def test_budget(self):
+        server = self._serve(([(b'id', 8)], []), ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'0')]))
+
+        qs = ds.SphinxQuerySet(index='one').query('typo')
+        with search_budget(10):
+            self.assertEqual([], list(qs))
+            time.sleep(0.01)
+            self.assertEqual([], list(qs._clone()))
+            self.assertFalse(qs._clone().exists())
+            self.assertEqual(0, qs._clone().count())
+
+        # ответ, урезанный бюджетом, мог быть пустым из-за нехватки времени
+        self.assertEqual(4, len(server.queries))
+        self.assertTrue(all('max_query_time=' in query for query in server.queries))
+        self.assertEqual([], list(qs._clone()))
+        self.assertEqual(5, len(server.queries))
+
+    def test_budget_cached(self):
+        server = self._serve(([(b'id', 8)], []), ([(b'Variable_name', 253), (b'Value', 253)], [(b'total_found', b'0')]))
+        self.addCleanup(result_cache.clear)
+
+        # кэшируемый запрос выполняется без ограничения из бюджета
+        qs = ds.SphinxQuerySet(index='one').query('typo').cache(30)
+        with search_budget(10):
+            self.assertEqual([], list(qs))
+        self.assertFalse(qs._clone().cache(None).exists())
+        self.assertEqual(1, len(server.queries))
+
+
+class ThreadResultsQuerySet(ds.SphinxQuerySet):
+    def _fetch(self):
+        self._result_cache = [threading.current_thread().name]
+        self._metadata = EMPTY_RESULT_SET
+        return self
+
+
+class TestFetchAsync(TestCase):
+
+    def test_fetch_async(self):
+        qs = ThreadResultsQuerySet()
+
+        qs1 = qs.fetch_async()
+        self.assertNotEqual(None, qs1._pending)
+        self.assertEqual(None, qs._pending)
+
+        self.assertNotEqual([threading.current_thread().name], list(qs1))
+        self.assertEqual(EMPTY_RESULT_SET, qs1.meta)
+        self.assertEqual(None, qs1._pending)
+
+        self.assertEqual(None, qs1.all()._pending)
+
+    def test_close_connections(self):
+        closed = []
+
+        class Connection(object):
+            def close(self):
+                closed.append(threading.current_thread().name)
+
+        class Connections(object):
+            def all(self):
+                return [Connection(), Connection()]
+
+        class FailingQuerySet(ds.SphinxQuerySet):
+            def _get_query(self, meta=False, capped=True):
+                raise SearchError('failed')
+
+        connections, sphinx_queryset.connections = sphinx_queryset.connections, Connections()
+        self.addCleanup(setattr, sphinx_queryset, 'connections', connections)
+
+        # подключения потока пула к БД закрываются и при ошибке запроса
+        self.assertRaises(SearchError, list, FailingQuerySet().fetch_async())
+        self.assertEqual(2, len(closed))
+        self.assertFalse(threading.current_thread().name in closed)
+
+
 class TestSphinxQuerySet(TestCase):
 
     def test__parse_indexes(self):